@@ -0,0 +1,67 @@
+# Compares the global track dense layers with weights tiled over the batch (previous fullyConnected) and plain matmuls (current one).
+# Run from the repository root : python -m benchmarks.fullyConnected --channels 2048
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+from models.cnn import tf, fullyConnected
+from utils.profiling import peak_allocator_bytes
+
+def fullyConnectedTiled(input, outputDim, useBias, layerName = "layer", initMultiplyer = 1.0):
+    with tf.variable_scope("fully_connected"):
+        batchSize = tf.shape(input)[0];
+        inputChannels = int(input.get_shape()[-1])
+        weights = tf.get_variable("weight", [inputChannels, outputDim ], dtype=tf.float32, initializer=tf.random_normal_initializer(0, initMultiplyer * tf.sqrt(1.0/float(inputChannels))))
+        weightsTiled = tf.tile(tf.expand_dims(weights, axis = 0), [batchSize, 1,1])
+        outputs = tf.matmul(tf.expand_dims(input, axis = 1), weightsTiled)
+        outputs = tf.squeeze(outputs, [1])
+        if(useBias):
+            bias = tf.get_variable("bias", [outputDim], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.002))
+            outputs = outputs + tf.expand_dims(bias, axis = 0)
+        return outputs
+
+# A chain of nbLayers dense layers like the globalNetwork_fc_* track, with the gradients of all weights.
+def build(layerFunction, batchSize, channels, nbLayers):
+    tf.reset_default_graph()
+    input = tf.random_normal([batchSize, channels])
+    output = input
+    for layerId in range(nbLayers):
+        with tf.variable_scope("globalNetwork_fc_%d" % (layerId + 1)):
+            output = tf.nn.selu(layerFunction(output, channels, True))
+    loss = tf.reduce_mean(output)
+    gradients = tf.gradients(loss, tf.trainable_variables())
+    return tf.group(*gradients)
+
+def run(layerFunction, batchSize, channels, nbLayers, nbSteps):
+    step = build(layerFunction, batchSize, channels, nbLayers)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(step)
+        run_metadata = tf.RunMetadata()
+        sess.run(step, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+        start = time.time()
+        for i in range(nbSteps):
+            sess.run(step)
+        duration = (time.time() - start) / nbSteps
+    peak = max(list(peak_allocator_bytes(run_metadata).values()) + [0])
+    return duration, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=512, help="width of the dense layers, ngf * 8 * depthFactor in the generator")
+    parser.add_argument("--layers", type=int, default=16, help="number of dense layers")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--steps", type=int, default=50)
+    benchArgs = parser.parse_args()
+
+    print("batch  implementation  ms/step  peak MB")
+    for batchSize in benchArgs.batch_sizes:
+        for name, layerFunction in [("tiled", fullyConnectedTiled), ("matmul", fullyConnected)]:
+            duration, peak = run(layerFunction, batchSize, benchArgs.channels, benchArgs.layers, benchArgs.steps)
+            print("%5d  %14s  %7.2f  %7.1f" % (batchSize, name, duration * 1000.0, peak / 2.0**20))
+
+if __name__ == "__main__":
+    main()
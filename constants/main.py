@@ -1,2 +1,4 @@
 EPS = 1e-12
-CROP_SIZE = 256
\ No newline at end of file
+CROP_SIZE = 256
+#A batch that waited less than this (in seconds) in the prefetch buffer means the step waited for the input pipeline
+INPUT_BOUND_SECONDS = 0.001
@@ -13,14 +13,25 @@ import random
 import collections
 import math
 import time
-from lxml import etree
 from random import shuffle
 # import tensorflow._api.v2.compat.v1 as tf
 # tf.disable_v2_behavior()
 
-from models.input import inputMaterial
-from constants.main import EPS, CROP_SIZE
+from utils.materialIndex import load_material_index, MaterialSampler
+from constants.main import EPS, CROP_SIZE, INPUT_BOUND_SECONDS
 from utils.parser import parse_arguments
+from utils.records import ShardWriter, read_cache_manifest, parse_cached_example
+from utils.lightBank import load_or_create_light_bank
+from utils.profiling import print_peak_memory
+from utils.tiling import pad_to_tile, tile_batches, BandBlender
+from utils.frozen import FROZEN_GRAPH, EXPORT_MANIFEST, EXPORT_INPUT, EXPORT_OUTPUTS
+from utils.server import serve
+from utils.writer import AsyncWriter
+from utils.outputFormats import create_map_writer
+from utils.report import ResultsReport
+from utils.metrics import METRIC_NAMES, metric_light_set, MetricsWriter
+from utils.allreduce import RingAllReduce, worker_addresses, spawn_local_workers
+from utils.watcher import spawn_evaluator, watch_checkpoints, mark_training_done, clear_training_done
 from models.cnn import *
 
 #Under MIT License
@@ -32,7 +43,7 @@ from models.cnn import *
 
 args = parse_arguments()
 
-if args.testMode == "auto":
+if args.testMode == "auto" and args.input_dir is not None:
     if args.input_dir.lower().endswith(".xml"):
         args.testMode = "xml";
     elif os.path.isdir(args.input_dir):
@@ -40,8 +51,9 @@ if args.testMode == "auto":
     else:
         args.testMode = "image";
 
-Examples = collections.namedtuple("Examples", "iterator, paths, inputs, targets, count, steps_per_epoch")
-Model = collections.namedtuple("Model", "outputs, gen_loss_L1, gen_grads_and_vars, train, rerendered, gen_loss_L1_exact")
+Examples = collections.namedtuple("Examples", "iterator, paths, inputs, targets, count, steps_per_epoch, buffer_time, bank_indices, bank_renderings")
+Model = collections.namedtuple("Model", "outputs, gen_loss_L1, gen_grads_and_vars, train, rerendered, gen_loss_L1_exact, gradient_feeds, accumulate")
+TiledInference = collections.namedtuple("TiledInference", "path, image, input_image, input_png, statistics, tiles, outputs, rows, maps, map, map_png")
 
 if args.depthFactor == 0:
     args.depthFactor = args.nbTargets
@@ -76,39 +88,6 @@ def tf_generate_distance(batchSize):
     gaussian = tf.random_normal([batchSize, 1], 0.5, 0.75, dtype=tf.float32) # parameters chosen empirically to have a nice distance from a -1;1 surface.
     return (tf.exp(gaussian))
     
-def createMaterialTable(examplesDict, shuffleImages):
-    materialsList = []
-    pathsList = []
-    flatPathsList = []
-    examplesDictKeys = examplesDict.keys()
-    examplesDictKeys = sorted(examplesDict)
-    
-    for substanceName in examplesDictKeys:
-        #print(substanceName)
-        for variationKey, variationList in examplesDict[substanceName].items():
-            materialsList.append(variationList)
-            tmpPathList = []
-            if args.mode == "test":
-                for variation in variationList:
-                    tmpPathList.append(variation.path)
-            else:
-                if len(variationList) > 1:
-                    randomChoices = np.random.choice(variationList, 2, replace = False)
-                    tmpPathList.append(randomChoices[0].path)
-                    tmpPathList.append(randomChoices[1].path)
-                else:
-                    tmpPathList.append(variationList[0].path)
-            pathsList.append(tmpPathList)
-    if shuffleImages == True:
-        shuffle(pathsList)
-
-    for elem in pathsList:
-        #if len(elem) < 2:
-        #    print(elem)
-        flatPathsList.extend(elem)
-    return flatPathsList
-    #Here we have a list of smallVariations 
-
 def readInputImage(inputPath):
     return [inputPath]
         
@@ -121,59 +100,29 @@ def readInputFolder(input_dir, shuffleList):
     pathList = sorted(pathList);
     
     if shuffleList:
+        #training set, split between the --workers from the sorted list.
+        pathList = pathList[args.workerRank::args.workers]
         shuffle(pathList)
     return pathList
     
+#Returns a MaterialSampler instead of a list, the paths are drawn again for each epoch when shuffling.
 def readInputXML(inputPath, shuffleList):
-    exampleDict = {}
-    pathDict = {}
-    tree = etree.parse(inputPath)
-    for elem in tree.findall('.//item'):
-        imagePath = elem.find('image').text
-        if not (imagePath is None) and os.path.exists(imagePath):
-            lightPower = elem.find('lightPower').text
-            lightXPos = elem.find('lightXPos').text
-            lightYPos = elem.find('lightYPos').text
-            lightZPos = elem.find('lightZPos').text
-            camXPos = elem.find('camXPos').text
-            camYPos = elem.find('camYPos').text
-            camZPos = elem.find('camZPos').text
-            uvscale = elem.find('uvscale').text
-            uoffset = elem.find('uoffset').text
-            voffset = elem.find('voffset').text
-            rotation = elem.find('rotation').text
-            identifier = elem.find('identifier').text
-            
-            substanceName = imagePath.split("/")[-1]
-            if(substanceName.split('.')[0].isdigit()):
-                substanceName = '%04d' % int(substanceName.split('.')[0])
-            substanceNumber = 0
-            imageSplitsemi = imagePath.split(";")
-            if len(imageSplitsemi) > 1:                    
-                substanceName = imageSplitsemi[1]
-                substanceNumber = imageSplitsemi[2].split(".")[0]
-            #def __init__(self, name, lightPower, lightXPos, lightYPos, lightZPos, camXPos, camYPos, camZPos, uvscale, uoffset, voffset, rotation, identifier, path):
-
-            material = inputMaterial(substanceName, lightPower, lightXPos, lightYPos, lightZPos, camXPos, camYPos, camZPos, uvscale, uoffset, voffset, rotation, identifier, imagePath)
-            idkey = str(substanceNumber) +";"+ identifier.rsplit(";", 1)[0]
-            
-            if not (substanceName in exampleDict) :
-                exampleDict[substanceName] = {idkey : [material]}
-                pathDict[imagePath] = material # Add only a path to be queried as for each image we will grab the others that are alike with the other dict
-
-            else:
-                if not (idkey in exampleDict[substanceName]):
-                    exampleDict[substanceName][idkey] = [material]
-                    pathDict[imagePath] = material # Add only a path to be queried as for each image we will grab the others that are alike with the other dict
+    index = load_material_index(inputPath)
+    print("dict length : " + str(len(index.substanceNames)))
+    if shuffleList:
+        return MaterialSampler(index, args.mode == "test", shuffleList, shuffleList, args.seed, args.workerRank, args.workers)
+    return MaterialSampler(index, args.mode == "test", shuffleList, shuffleList, args.seed)
 
-                else:
-                    exampleDict[substanceName][idkey].append(material)
-    print("dict length : " + str(len(exampleDict.items())))
-    flatPathList = createMaterialTable(exampleDict, shuffleList)
-    return flatPathList
+def _read_function(filename):
+    return filename, tf.read_file(filename)
 
 def _parse_function(filename):
-    image_string = tf.read_file(filename)
+    return _decode_function(*_read_function(filename))
+
+def _parse_input_function(filename):
+    return _decode_input_function(*_read_function(filename))
+
+def _decode_image(image_string):
     raw_input = tf.image.decode_image(image_string)
     raw_input = tf.image.convert_image_dtype(raw_input, dtype=tf.float32)
     
@@ -182,21 +131,44 @@ def _parse_function(filename):
     with tf.control_dependencies([assertion]):
         raw_input = tf.identity(raw_input)
         raw_input.set_shape([None, None, 3])
-        images=[]
-        input = raw_input
-        #add black images as targets (this is a hack and should be removed for a real test code pipeline).
-        if args.mode == "eval":
-            shape = tf.shape(input)
-            black = tf.zeros([shape[0], shape[1]  * args.nbTargets, shape[2]], dtype=tf.float32)
-            input = tf.concat([input, black], axis=1)
-        width = tf.shape(input)[1] # [height, width, channels]
-        imageWidth = width // (args.nbTargets + 1)
-
-        for imageId in range(args.nbTargets + 1):
-            beginning = imageId * imageWidth
-            end = (imageId+1) * imageWidth
-            images.append(input[:,beginning:end,:])
+    return raw_input
+
+def _split_panels(image_string):
+    input = _decode_image(image_string)
+    images=[]
+    width = tf.shape(input)[1] # [height, width, channels]
+    imageWidth = width // (args.nbTargets + 1)
+
+    for imageId in range(args.nbTargets + 1):
+        beginning = imageId * imageWidth
+        end = (imageId+1) * imageWidth
+        images.append(input[:,beginning:end,:])
+    return images
+
+def _transform(image, resize = True):
+    r = image
+    #if a.flip:
+    #    r = tf.image.random_flip_left_right(r, seed=seed)
+
+    # area produces a nice downscaling, but does nearest neighbor for upscaling
+    # assume we're going to be doing downscaling here
+    if resize:
+        r = tf.image.resize_images(r, [args.scale_size, args.scale_size], method=tf.image.ResizeMethod.AREA)
+    return r
+
+def _prepare_input(inputs, resize = True):
+    if args.correctGamma:
+        inputs = tf.pow(inputs, 2.2)
 
+    if args.useLog:
+        inputs = logTensor(inputs)
+    inputs = preprocess(inputs)
+
+    with tf.name_scope("input_images"):
+        input_images = _transform(inputs, resize)
+    return input_images
+
+def _prepare_images(images, resize = True):
     if args.which_direction == "AtoB":
         inputs, targets = [images[0], images[1:]]
     elif args.which_direction == "BtoA":
@@ -204,41 +176,51 @@ def _parse_function(filename):
     else:
         raise Exception("invalid direction")
         
-    if args.correctGamma:
-        inputs = tf.pow(inputs, 2.2)
-
-    if args.useLog:
-        inputs = logTensor(inputs)
-    inputs = preprocess(inputs)
+    input_images = _prepare_input(inputs, resize)
     targetsTmp = []
     for target in targets:
         targetsTmp.append(preprocess(target))
     targets = targetsTmp
     # synchronize seed for image operations so that we do the same operations to both
     # input and output images 
-    
-    def transform(image):
-        r = image
-        #if a.flip:
-        #    r = tf.image.random_flip_left_right(r, seed=seed)
-
-        # area produces a nice downscaling, but does nearest neighbor for upscaling
-        # assume we're going to be doing downscaling here
-        r = tf.image.resize_images(r, [args.scale_size, args.scale_size], method=tf.image.ResizeMethod.AREA)
-        return r
-
-    with tf.name_scope("input_images"):
-        input_images = transform(inputs)
 
     with tf.name_scope("target_images"):
         target_images = []
         for target in targets:
-            target_images.append(transform(target))
+            target_images.append(_transform(target, resize))
     
+    return input_images, target_images
+
+def _decode_function(filename, image_string):
+    input_images, target_images = _prepare_images(_split_panels(image_string))
     return filename, input_images, target_images    
 
-def load_examples(input_dir, shuffleValue):
-    test_queue = tf.constant([" "])
+#Eval inputs are plain pictures without target panels.
+def _decode_input_function(filename, image_string):
+    return filename, _prepare_input(_decode_image(image_string))
+
+#Resized but otherwise untouched panels, stored as uint8 by the cache mode. Gamma, log and [-1, 1] preprocessing are applied when the cache is read.
+def _cache_panels_function(filename, image_string):
+    panels = []
+    for image in _split_panels(image_string):
+        panels.append(tf.image.resize_images(image, [args.scale_size, args.scale_size], method=tf.image.ResizeMethod.AREA))
+    return filename, tf.image.convert_image_dtype(tf.stack(panels, axis = 0), dtype=tf.uint8, saturate=True)
+
+def _cached_example_function(serialized):
+    filename, panels = parse_cached_example(serialized, args.nbTargets, args.scale_size)
+    panels = tf.image.convert_image_dtype(panels, dtype=tf.float32)
+    input_images, target_images = _prepare_images(tf.unstack(panels, axis = 0), resize = False)
+    return filename, input_images, target_images
+
+def _decode_threads():
+    if args.inputPipeline != "parallel":
+        return 1
+    return args.inputThreads if args.inputThreads > 0 else tf.data.experimental.AUTOTUNE
+
+def _read_threads():
+    return args.readCycle if args.inputPipeline == "parallel" else None
+
+def readInputPaths(input_dir, shuffleValue):
     if input_dir is None or not os.path.exists(input_dir):
         raise Exception("input_dir does not exist")
     flatPathList = []
@@ -251,62 +233,237 @@ def load_examples(input_dir, shuffleValue):
     
     if len(flatPathList) == 0:
         raise Exception("input_dir contains no image files")
-    with tf.name_scope("load_images"):
+    return flatPathList
+
+def decoded_dataset(flatPathList):
+    if isinstance(flatPathList, MaterialSampler):
+        dataset = tf.data.Dataset.from_generator(flatPathList, tf.string, tf.TensorShape([]))
+    else:
         filenamesTensor = tf.constant(flatPathList) 
         dataset = tf.data.Dataset.from_tensor_slices(filenamesTensor)
-        dataset = dataset.map(_parse_function, num_parallel_calls=1)
-        dataset = dataset.repeat()
+    inputOnly = args.mode == "eval"
+    if args.inputPipeline == "parallel":
+        dataset = dataset.interleave(lambda filename: tf.data.Dataset.from_tensors(_read_function(filename)), cycle_length=args.readCycle, num_parallel_calls=_read_threads())
+        dataset = dataset.map(_decode_input_function if inputOnly else _decode_function, num_parallel_calls=_decode_threads())
+    else:
+        dataset = dataset.map(_parse_input_function if inputOnly else _parse_function, num_parallel_calls=1)
+    return dataset
+
+#Streams whole shards sequentially, only the shard order and a bounded window of examples are shuffled.
+def cached_dataset(shardPaths, shuffleValue):
+    if shuffleValue and args.workers > 1:
+        #each of the --workers streams its own shards.
+        if len(shardPaths) < args.workers:
+            raise Exception("the cache has %d shards, less than the %d workers" % (len(shardPaths), args.workers))
+        shardPaths = shardPaths[args.workerRank::args.workers]
+    dataset = tf.data.Dataset.from_tensor_slices(tf.constant(shardPaths))
+    if shuffleValue:
+        dataset = dataset.shuffle(len(shardPaths))
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=args.readCycle, num_parallel_calls=_read_threads())
+    dataset = dataset.map(_cached_example_function, num_parallel_calls=_decode_threads())
+    if shuffleValue and args.cacheShuffleBuffer > 1:
+        dataset = dataset.shuffle(args.cacheShuffleBuffer)
+    return dataset
+
+def write_cache(input_dir, cacheDir):
+    flatPathList = readInputPaths(input_dir, False)
+    if isinstance(flatPathList, MaterialSampler):
+        flatPathList = list(flatPathList())
+    with tf.name_scope("cache_images"):
+        dataset = tf.data.Dataset.from_tensor_slices(tf.constant(flatPathList))
+        dataset = dataset.map(_read_function, num_parallel_calls=_read_threads())
+        dataset = dataset.map(_cache_panels_function, num_parallel_calls=_decode_threads())
+        dataset = dataset.prefetch(args.batch_size)
+        next_example = dataset.make_one_shot_iterator().get_next()
+
+    writer = ShardWriter(cacheDir, args.shardSize, args.scale_size, args.nbTargets)
+    with tf.Session() as sess:
+        while True:
+            try:
+                path, panels = sess.run(next_example)
+            except tf.errors.OutOfRangeError:
+                break
+            writer.write(path, panels.tobytes())
+            if args.progress_freq > 0 and writer.count % args.progress_freq == 0:
+                print("cached %d / %d examples" % (writer.count, len(flatPathList)))
+    manifest = writer.close()
+    print("wrote %d examples in %d shards to %s" % (manifest["count"], len(manifest["shards"]), cacheDir))
+
+#Takes args.cropsPerDecode crops at independent random offsets from one decoded example.
+def _random_crops(filename, input_images, target_images):
+    offsets = tf.random_uniform([args.cropsPerDecode, 2], 0, args.scale_size - CROP_SIZE, dtype=tf.int32)
+    def crop(offset):
+        input_crop = input_images[offset[0] : offset[0] + CROP_SIZE, offset[1] : offset[1] + CROP_SIZE, :]
+        target_crop = target_images[:, offset[0] : offset[0] + CROP_SIZE, offset[1] : offset[1] + CROP_SIZE, :]
+        return filename, input_crop, target_crop
+    return tf.data.Dataset.from_tensor_slices(offsets).map(crop)
+
+def _sample_light_bank_indices(lightBankSize):
+    diffuseIds = tf.random_shuffle(tf.range(lightBankSize))[:args.nbDiffuseRendering]
+    specularIds = tf.random_shuffle(tf.range(lightBankSize))[:args.nbSpecularRendering]
+    return diffuseIds, specularIds
+
+#[nbTargets, width, height, 3] => [1, width, height, 3 * nbTargets], the layout create_model works with.
+def _targets_svbrdf(target_images):
+    return tf.expand_dims(tf.concat(tf.unstack(target_images, num = args.nbTargets, axis = 0), axis = -1), axis = 0)
+
+#Renders the ground truth of each example under its light bank configurations in the input pipeline, so that the training step only renders the outputs.
+#With --lightBankCache the whole bank is rendered once per example and cached, then a subset is drawn for each step.
+#The cache holds the first epoch as it was read (examples and order) with 2 * lightBankSize renderings of each example.
+def light_bank_dataset(dataset, lightBank):
+    lightBankSize = len(lightBank["diffuseLights"])
+    if args.lightBankCache is None:
+        def render_sampled(filename, input_images, target_images):
+            diffuseIds, specularIds = _sample_light_bank_indices(lightBankSize)
+            renderings = tf_renderLightBank(_targets_svbrdf(target_images), lightBank, diffuseIds, specularIds, tf_surfaceArray())
+            return filename, input_images, target_images, tf.concat([diffuseIds, specularIds + lightBankSize], axis = 0), renderings
+        return dataset.map(render_sampled, num_parallel_calls=_decode_threads())
+
+    def render_all(filename, input_images, target_images):
+        allIds = tf.range(lightBankSize)
+        return filename, input_images, target_images, tf_renderLightBank(_targets_svbrdf(target_images), lightBank, allIds, allIds, tf_surfaceArray())
+    def sample(filename, input_images, target_images, renderings):
+        diffuseIds, specularIds = _sample_light_bank_indices(lightBankSize)
+        indices = tf.concat([diffuseIds, specularIds + lightBankSize], axis = 0)
+        return filename, input_images, target_images, indices, tf.gather(renderings, indices)
+    dataset = dataset.map(render_all, num_parallel_calls=_decode_threads())
+    dataset = dataset.cache(args.lightBankCache)
+    return dataset.map(sample, num_parallel_calls=_decode_threads())
+
+def load_examples(input_dir, shuffleValue, cacheDir = None, lightBank = None):
+    test_queue = tf.constant([" "])
+    with tf.name_scope("load_images"):
+        if cacheDir is not None:
+            manifest = read_cache_manifest(cacheDir)
+            if manifest["scale_size"] != args.scale_size or manifest["nbTargets"] != args.nbTargets:
+                raise Exception("cache in " + cacheDir + " was written with scale_size " + str(manifest["scale_size"]) + " and nbTargets " + str(manifest["nbTargets"]))
+            count = manifest["count"]
+            if shuffleValue and args.workers > 1:
+                #only counts the shards of this worker, all of them but the last one hold shardSize examples.
+                count = int(round(count * len(manifest["shards"][args.workerRank::args.workers]) / float(len(manifest["shards"]))))
+            dataset = cached_dataset(manifest["shards"], shuffleValue)
+        else:
+            flatPathList = readInputPaths(input_dir, shuffleValue)
+            count = len(flatPathList)
+            dataset = decoded_dataset(flatPathList)
+
+        buffer_time = None
+        bank_indices = None
+        bank_renderings = None
+        multiCrop = shuffleValue and args.cropsPerDecode > 1
+        if multiCrop:
+            if args.scale_size <= CROP_SIZE:
+                raise Exception("--cropsPerDecode needs scale_size to be larger than " + str(CROP_SIZE))
+        #Light bank renderings depend on the crop, so crops have to be taken per example before rendering.
+        exampleCrops = multiCrop or (lightBank is not None and args.scale_size > CROP_SIZE)
+        if exampleCrops:
+            if lightBank is not None and args.lightBankCache is not None:
+                raise Exception("--lightBankCache needs scale_size to be " + str(CROP_SIZE) + " so that the cached renderings do not depend on a random crop")
+            dataset = dataset.flat_map(_random_crops)
+            if multiCrop:
+                dataset = dataset.shuffle(args.cropShuffleBuffer)
+        if lightBank is not None:
+            dataset = light_bank_dataset(dataset, lightBank)
+        #Evaluation sets are read exactly once : the iterator ends with an OutOfRangeError after a last batch holding the remaining examples.
+        if shuffleValue:
+            dataset = dataset.repeat()
         batched_dataset = dataset.batch(args.batch_size)
+        if args.inputPipeline == "parallel":
+            prefetchBatches = args.prefetchBatches if args.prefetchBatches > 0 else tf.data.experimental.AUTOTUNE
+            #Stamp each batch when it is ready so we can tell how long it waited in the prefetch buffer.
+            batched_dataset = batched_dataset.map(lambda *batch: batch + (tf.timestamp(),))
+            batched_dataset = batched_dataset.prefetch(prefetchBatches)
         #batched_dataset = batched_dataset.filter(lambda paths, blah, _: tf.equal(tf.shape(paths)[0], a.batch_size))
 
         iterator = batched_dataset.make_initializable_iterator()
-        paths_batch, inputs_batch, targets_batch = iterator.get_next()
+        batch = iterator.get_next()
+        if args.inputPipeline == "parallel":
+            ready_time = batch[-1]
+            batch = batch[:-1]
+            with tf.control_dependencies([ready_time]):
+                buffer_time = tf.timestamp() - ready_time
+        #In eval mode there are no targets, only the paths and the inputs.
+        paths_batch, inputs_batch = batch[0], batch[1]
+        targets_batch = batch[2] if len(batch) > 2 else None
+        if len(batch) > 3:
+            bank_indices, bank_renderings = batch[3], batch[4]
         
-        if args.scale_size > CROP_SIZE:
+        if args.scale_size > CROP_SIZE and not exampleCrops:
             xyCropping = tf.random_uniform([2], 0, args.scale_size - CROP_SIZE, dtype=tf.int32)
             inputs_batch = inputs_batch[:, xyCropping[0] : xyCropping[0] + CROP_SIZE, xyCropping[1] : xyCropping[1] + CROP_SIZE, :]
-            targets_batch = targets_batch[:,:, xyCropping[0] : xyCropping[0] + CROP_SIZE, xyCropping[1] : xyCropping[1] + CROP_SIZE, :]
+            if targets_batch is not None:
+                targets_batch = targets_batch[:,:, xyCropping[0] : xyCropping[0] + CROP_SIZE, xyCropping[1] : xyCropping[1] + CROP_SIZE, :]
         #paths_batch.set_shape([a.batch_size])
-        print("targets_batch_0 : " + str(targets_batch.get_shape()))        
         
         inputs_batch.set_shape([None, CROP_SIZE, CROP_SIZE, inputs_batch.get_shape()[-1] ])
-        targets_batch.set_shape([None, args.nbTargets, CROP_SIZE, CROP_SIZE, targets_batch.get_shape()[-1] ])
+        if targets_batch is not None:
+            print("targets_batch_0 : " + str(targets_batch.get_shape()))        
+            targets_batch.set_shape([None, args.nbTargets, CROP_SIZE, CROP_SIZE, targets_batch.get_shape()[-1] ])
 
         
     #paths_batch, inputs_batch, targets_batch = tf.train.batch([paths, input_images, target_images], batch_size=a.batch_size, num_threads=1)
     tf.summary.text("batch paths", paths_batch)
     
-    steps_per_epoch = int(math.floor(len(flatPathList) / args.batch_size))
+    if multiCrop:
+        count = count * args.cropsPerDecode
+    if shuffleValue:
+        #a training step reads accumulateSteps batches.
+        steps_per_epoch = int(math.floor(count / (args.batch_size * args.accumulateSteps)))
+    else:
+        steps_per_epoch = int(math.ceil(count / args.batch_size))
     print("steps per epoch : " + str(steps_per_epoch))
     #[batchsize, nbMaps, 256,256,3] Do the reshape by hand and probably concat it on third axis so we are sure of the reshape.
     print("inputs_batch : " + str(inputs_batch.get_shape()))    
-    print("targets_batch : " + str(targets_batch.get_shape()))
-    targets_batch_concat = targets_batch[:,0]
-    print("targets_batch_concat : " + str(targets_batch_concat.get_shape()))
-    for imageId in range(1, args.nbTargets):
-        targets_batch_concat = tf.concat([targets_batch_concat, targets_batch[:,imageId]], axis = -1)
-    
-    targets_batch = targets_batch_concat
-    print("targets size : " + str(targets_batch.get_shape()))
+    if targets_batch is not None:
+        print("targets_batch : " + str(targets_batch.get_shape()))
+        targets_batch_concat = targets_batch[:,0]
+        print("targets_batch_concat : " + str(targets_batch_concat.get_shape()))
+        for imageId in range(1, args.nbTargets):
+            targets_batch_concat = tf.concat([targets_batch_concat, targets_batch[:,imageId]], axis = -1)
+        
+        targets_batch = targets_batch_concat
+        print("targets size : " + str(targets_batch.get_shape()))
 
     return Examples(
         iterator=iterator,
         paths=paths_batch,
         inputs=inputs_batch,
         targets=targets_batch,
-        count=len(flatPathList),
+        count=count,
         steps_per_epoch=steps_per_epoch,
+        buffer_time=buffer_time,
+        bank_indices=bank_indices,
+        bank_renderings=bank_renderings,
     )
     
 def logTensor(tensor):
     return  (tf.log(tf.add(tensor,0.01)) - tf.log(0.01)) / (tf.log(1.01)-tf.log(0.01))
     
-def create_generator(generator_inputs, generator_outputs_channels):
+def compute_dtype(precision = None):
+    return tf.bfloat16 if (precision or args.precision) == "bfloat16" else tf.float32
+
+#precision overrides args.precision, the convolutions run in that dtype while the global network, the normalization statistics and the outputs stay float32.
+#The per image (mean, variance) of the input and of every normalized layer are appended to recordStatistics when given, in the order they are computed.
+#statistics, a list in the same order, replaces them : the tiles of create_tiled_inference use the ones of the whole downsampled picture.
+def create_generator(generator_inputs, generator_outputs_channels, precision = None, statistics = None, recordStatistics = None):
     print("generator_inputs :" + str(generator_inputs.get_shape()))
     print("generator_outputs_channels :" + str(generator_outputs_channels))
+    fixedStatistics = list(statistics) if statistics is not None else None
+    def next_statistics():
+        return fixedStatistics.pop(0) if fixedStatistics is not None else None
+    def moments(tensor, keep_dims):
+        layerStatistics = next_statistics()
+        if layerStatistics is None:
+            layerStatistics = tf.nn.moments(tf.cast(tensor, tf.float32), axes=[1, 2], keep_dims=keep_dims)
+        record(*layerStatistics)
+        return layerStatistics
+    def record(mean, variance):
+        if recordStatistics is not None:
+            recordStatistics.append((mean, variance))
     layers = []
     #Input here should be [batch, 256,256,3]
-    inputMean, inputVariance = tf.nn.moments(generator_inputs, axes=[1, 2], keep_dims=False)
+    inputMean, inputVariance = moments(generator_inputs, keep_dims=False)
+    generator_inputs = tf.cast(generator_inputs, compute_dtype(precision))
     globalNetworkInput = inputMean
     globalNetworkOutputs = []
     with tf.variable_scope("globalNetwork_fc_1"):    
@@ -330,13 +487,11 @@ def create_generator(generator_inputs, generator_outputs_channels):
     
     for layerCount, out_channels in enumerate(layer_specs):
         with tf.variable_scope("encoder_%d" % (len(layers) + 1)):
-            rectified = lrelu(layers[-1], 0.2)
-            # [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels]
-            convolved = conv(rectified, out_channels, stride=2)
+            # lrelu then [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels] then instancenorm
             #here mean and variance will be [batch, 1, 1, out_channels]
-            outputs, mean, variance = instancenorm(convolved)
+            outputs, mean, variance = conv_block(layers[-1], out_channels, stride=2, recompute=args.recomputeActivations, bias=GlobalToGenerator(globalNetworkOutputs[-1], out_channels), fused=args.fusedNorm, statistics=next_statistics())
+            record(mean, variance)
             
-            outputs = outputs + GlobalToGenerator(globalNetworkOutputs[-1], out_channels)
             with tf.variable_scope("globalNetwork_fc_%d" % (len(globalNetworkOutputs) + 1)):  
                 nextGlobalInput = tf.concat([tf.expand_dims(tf.expand_dims(globalNetworkOutputs[-1], axis = 1), axis=1), mean], axis = -1)  
                 globalNetwork_fc = ""
@@ -349,13 +504,12 @@ def create_generator(generator_inputs, generator_outputs_channels):
             layers.append(outputs)
 
     with tf.variable_scope("encoder_8"):
-        rectified = lrelu(layers[-1], 0.2)
-         # [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels]
-        convolved = conv(rectified, args.ngf * 8 * args.depthFactor, stride=2)
-        convolved = convolved  + GlobalToGenerator(globalNetworkOutputs[-1], args.ngf * 8 * args.depthFactor)
+         # lrelu then [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels]
+        convolved = conv_block(layers[-1], args.ngf * 8 * args.depthFactor, stride=2, normalize=False, recompute=args.recomputeActivations, fused=args.fusedNorm)
+        convolved = convolved  + as_input_dtype(GlobalToGenerator(globalNetworkOutputs[-1], args.ngf * 8 * args.depthFactor), convolved)
         
         with tf.variable_scope("globalNetwork_fc_%d" % (len(globalNetworkOutputs) + 1)):  
-            mean, variance = tf.nn.moments(convolved, axes=[1, 2], keep_dims=True)
+            mean, variance = moments(convolved, keep_dims=True)
             nextGlobalInput = tf.concat([tf.expand_dims(tf.expand_dims(globalNetworkOutputs[-1], axis = 1), axis=1), mean], axis = -1)
             globalNetwork_fc = fullyConnected(nextGlobalInput, args.ngf * 8 * args.depthFactor, True, "globalNetworkLayer" + str(len(globalNetworkOutputs) + 1))
             globalNetworkOutputs.append(tf.nn.selu(globalNetwork_fc))  
@@ -383,12 +537,9 @@ def create_generator(generator_inputs, generator_outputs_channels):
             else:
                 input = tf.concat([layers[-1], layers[skip_layer]], axis=3)
 
-            rectified = lrelu(input, 0.2)
-            
-            # [batch, in_height, in_width, in_channels] => [batch, in_height*2, in_width*2, out_channels]
-            output = deconv(rectified, out_channels)
-            output, mean, variance = instancenorm(output)
-            output = output + GlobalToGenerator(globalNetworkOutputs[-1], out_channels)
+            # lrelu then [batch, in_height, in_width, in_channels] => [batch, in_height*2, in_width*2, out_channels] then instancenorm
+            output, mean, variance = deconv_block(input, out_channels, recompute=args.recomputeActivations, bias=GlobalToGenerator(globalNetworkOutputs[-1], out_channels), fused=args.fusedNorm, subpixel=args.subpixelDecoder, statistics=next_statistics())
+            record(mean, variance)
             with tf.variable_scope("globalNetwork_fc_%d" % (len(globalNetworkOutputs) + 1)):    
                 nextGlobalInput = tf.concat([tf.expand_dims(tf.expand_dims(globalNetworkOutputs[-1], axis = 1), axis=1), mean], axis = -1)
                 globalNetwork_fc = fullyConnected(nextGlobalInput, out_channels, True, "globalNetworkLayer" + str(len(globalNetworkOutputs) + 1))
@@ -401,10 +552,9 @@ def create_generator(generator_inputs, generator_outputs_channels):
     # decoder_1: [batch, 128, 128, ngf * 2] => [batch, 256, 256, generator_outputs_channels]
     with tf.variable_scope("decoder_1"):
         input = tf.concat([layers[-1], layers[0]], axis=3)
-        rectified = lrelu(input, 0.2)
-        output = deconv(rectified, generator_outputs_channels)
-        output = output + GlobalToGenerator(globalNetworkOutputs[-1], generator_outputs_channels)
-        output = tf.tanh(output)
+        output = deconv_block(input, generator_outputs_channels, normalize=False, recompute=args.recomputeActivations, fused=args.fusedNorm, subpixel=args.subpixelDecoder)
+        output = output + as_input_dtype(GlobalToGenerator(globalNetworkOutputs[-1], generator_outputs_channels), output)
+        output = tf.cast(tf.tanh(output), tf.float32)
         layers.append(output)
 
     return layers[-1]
@@ -448,6 +598,123 @@ def tf_generateSpecularRendering(batchSize, surfaceArray, targets, outputs):
     renderedSpecular = tf_Render(targets,wi,wo, includeDiffuse = args.includeDiffuse)           
     renderedSpecularOutputs = tf_Render(outputs,wi,wo, includeDiffuse = args.includeDiffuse)#tf_Render_Optis(outputs,wi,wo, includeDiffuse = a.includeDiffuse)
     return [renderedSpecular, renderedSpecularOutputs]
+
+#Same distribution as tf_generateDiffuseRendering, for nbRenderings renderings at once : wi and wo are [nbRenderings, batch, 1, 1, 3]
+def tf_generateDiffuseDirections(nbRenderings, batchSize):
+    directionsShape = [nbRenderings, batchSize, 1, 1, 3]
+    wo = tf.reshape(tf_generate_normalized_random_direction(nbRenderings * batchSize), directionsShape)
+    wi = tf.reshape(tf_generate_normalized_random_direction(nbRenderings * batchSize), directionsShape)
+    return wi, wo
+
+#Same distribution as tf_generateSpecularRendering, for nbRenderings renderings at once : wi and wo are [nbRenderings, batch, width, height, 3]
+def tf_generateSpecularDirections(nbRenderings, batchSize, surfaceArray):
+    lightPos, viewPos = tf_generateSpecularPositions(nbRenderings, batchSize)
+    return lightPos - surfaceArray, viewPos - surfaceArray
+
+#Light and view positions of tf_generateSpecularDirections, [nbRenderings, batch, 1, 1, 3] each.
+def tf_generateSpecularPositions(nbRenderings, batchSize):
+    nbDirections = nbRenderings * batchSize
+    currentViewDir = tf_generate_normalized_random_direction(nbDirections)
+    currentLightDir = currentViewDir * tf.expand_dims([-1.0, -1.0, 1.0], axis = 0)
+    #Shift position to have highlight elsewhere than in the center.
+    currentShift = tf.concat([tf.random_uniform([nbDirections, 2], -1.0, 1.0), tf.zeros([nbDirections, 1], dtype=tf.float32) + 0.0001], axis=-1)
+    
+    currentViewPos = tf.multiply(currentViewDir, tf_generate_distance(nbDirections)) + currentShift
+    currentLightPos = tf.multiply(currentLightDir, tf_generate_distance(nbDirections)) + currentShift
+
+    positionsShape = [nbRenderings, batchSize, 1, 1, 3]
+    return tf.reshape(currentLightPos, positionsShape), tf.reshape(currentViewPos, positionsShape)
+
+#Renders targets and outputs ([batch, width, height, 12]) together under all the wi, wo configurations ([nbRenderings, batch, ...,3]).
+#The materials are decoded once and broadcast over the renderings. Returns two [nbRenderings, batch, width, height, 3] tensors.
+def tf_RenderBatched(targets, outputs, wi, wo, includeDiffuse = True):
+    svbrdfs = tf.expand_dims(tf.stack([targets, outputs], axis = 0), axis = 1) # [2, 1, batch, width, height, 12]
+    renderings = tf_Render(svbrdfs, wi, wo, includeDiffuse = includeDiffuse)[0] # [2, nbRenderings, batch, width, height, 3]
+    return renderings[0], renderings[1]
+
+#All the diffuse then specular renderings of the rendering loss in a single pass each, stacked on the first axis.
+def tf_generateBatchedRenderings(batchSize, surfaceArray, targets, outputs):
+    renderedTargets = []
+    renderedOutputs = []
+    if args.nbDiffuseRendering > 0:
+        with tf.name_scope("diffuse"):
+            wi, wo = tf_generateDiffuseDirections(args.nbDiffuseRendering, batchSize)
+            diffuses = tf_RenderBatched(targets, outputs, wi, wo)
+            renderedTargets.append(diffuses[0])
+            renderedOutputs.append(diffuses[1])
+    if args.nbSpecularRendering > 0:
+        with tf.name_scope("specular"):
+            wi, wo = tf_generateSpecularDirections(args.nbSpecularRendering, batchSize, surfaceArray)
+            speculars = tf_RenderBatched(targets, outputs, wi, wo, includeDiffuse = args.includeDiffuse)
+            renderedTargets.append(speculars[0])
+            renderedOutputs.append(speculars[1])
+    return tf.concat(renderedTargets, axis = 0), tf.concat(renderedOutputs, axis = 0)
+
+#Configurations of the light bank for indices of any shape : wi and wo are indices.shape + [1, 1, 3] for diffuse and indices.shape + [width, height, 3] for specular renderings.
+def tf_lightBankDirections(lightBank, indices, kind, surfaceArray):
+    lights = tf.gather(tf.constant(lightBank[kind + "Lights"]), indices)
+    views = tf.gather(tf.constant(lightBank[kind + "Views"]), indices)
+    wi = tf.expand_dims(tf.expand_dims(lights, axis = -2), axis = -2)
+    wo = tf.expand_dims(tf.expand_dims(views, axis = -2), axis = -2)
+    if kind == "specular":
+        wi = wi - surfaceArray
+        wo = wo - surfaceArray
+    return wi, wo
+
+#Renders svbrdf under the diffuse then the specular configurations of the light bank, the indices leading dimensions are broadcast with the svbrdf ones.
+def tf_renderLightBank(svbrdf, lightBank, diffuseIds, specularIds, surfaceArray):
+    with tf.name_scope("diffuse"):
+        wi, wo = tf_lightBankDirections(lightBank, diffuseIds, "diffuse", surfaceArray)
+        diffuses = tf_Render(svbrdf, wi, wo)[0]
+    with tf.name_scope("specular"):
+        wi, wo = tf_lightBankDirections(lightBank, specularIds, "specular", surfaceArray)
+        speculars = tf_Render(svbrdf, wi, wo, includeDiffuse = args.includeDiffuse)[0]
+    return tf.concat([diffuses, speculars], axis = 0)
+
+#Rendering loss accumulated over chunks of args.renderChunkSize renderings. Each chunk only outputs its summed error, its renderings are recomputed
+#during the backward pass instead of being stored, and chunks are chained so that only one of them is in flight at a time, forward and backward.
+def tf_chunkedRenderingLoss(batchSize, surfaceArray, targets, outputs):
+    def chunkError(lights, views, specular, includeDiffuse):
+        def error(outputs, lights, views):
+            wi, wo = (lights - surfaceArray, views - surfaceArray) if specular else (lights, views)
+            renderedTargets, renderedOutputs = tf_RenderBatched(targets, outputs, wi, wo, includeDiffuse = includeDiffuse)
+            logDifference = tf_renderingLog(renderedTargets) - tf_renderingLog(renderedOutputs)
+            if args.loss == "renderL2":
+                return tf.reduce_sum(tf.square(logDifference))
+            return tf.reduce_sum(tf.abs(logDifference))
+        return recompute_grad(error)(outputs, lights, views)
+
+    chunks = []
+    if args.nbDiffuseRendering > 0:
+        with tf.name_scope("diffuse"):
+            wi, wo = tf_generateDiffuseDirections(args.nbDiffuseRendering, batchSize)
+            chunks.append((wi, wo, False, True, args.nbDiffuseRendering))
+    if args.nbSpecularRendering > 0:
+        with tf.name_scope("specular"):
+            lightPos, viewPos = tf_generateSpecularPositions(args.nbSpecularRendering, batchSize)
+            chunks.append((lightPos, viewPos, True, args.includeDiffuse, args.nbSpecularRendering))
+
+    totalError = 0.0
+    chunkId = 0
+    for lights, views, specular, includeDiffuse, nbRenderings in chunks:
+        for begin in range(0, nbRenderings, args.renderChunkSize):
+            with tf.name_scope("chunk_%d" % chunkId):
+                chunkLights = lights[begin:begin + args.renderChunkSize]
+                if chunkId > 0:
+                    #Zero valued data dependency on the previous chunk : it orders the chunks in the forward pass and, through its gradient, in the backward pass.
+                    chunkLights = chunkLights + 0.0 * totalError
+                totalError = totalError + chunkError(chunkLights, views[begin:begin + args.renderChunkSize], specular, includeDiffuse)
+            chunkId += 1
+    nbValues = tf.cast(tf.reduce_prod(tf.shape(outputs)[:-1]) * 3 * (args.nbDiffuseRendering + args.nbSpecularRendering), tf.float32)
+    return totalError / nbValues
+
+#Log space of the rendering loss, always computed in float32 whatever the rendering dtype.
+def tf_renderingLog(renderings):
+    return tf.log(tf.cast(renderings, tf.float32) + 0.01)
+
+#[nbRenderings, batch, width, height, 3] => [batch, width, height, 3 * nbRenderings], the layout of the looped rendering loss.
+def renderings_to_channels(renderings):
+    return tf.concat(tf.unstack(renderings, num = args.nbDiffuseRendering + args.nbSpecularRendering, axis = 0), axis = -1)
     
 def DX(x):
     return x[:,:,1:,:] - x[:,:,:-1,:]    # so this just subtracts the image from a single-pixel shifted version of itself (while cropping out two pixels because we don't know what's outside the image)
@@ -468,23 +735,19 @@ def loss_grad(x, y, alpha=0.2):
     return loss_val
     
 
-def create_model(inputs, targets, reuse_bool = False):
-    batchSize = tf.shape(inputs)[0]
-    surfaceArray=[]
-    if args.loss == "render" or args.loss == "renderL2":
-        XsurfaceArray = tf.expand_dims(tf.lin_space(-1.0, 1.0, CROP_SIZE), axis=-1)
-        XsurfaceArray = tf.tile(XsurfaceArray,[1,CROP_SIZE])
-        YsurfaceArray = -1 * tf.transpose(XsurfaceArray) #put -1 in the bottom of the table
-        XsurfaceArray = tf.expand_dims(XsurfaceArray, axis = -1)
-        YsurfaceArray = tf.expand_dims(YsurfaceArray, axis = -1)
+def tf_surfaceArray():
+    XsurfaceArray = tf.expand_dims(tf.lin_space(-1.0, 1.0, CROP_SIZE), axis=-1)
+    XsurfaceArray = tf.tile(XsurfaceArray,[1,CROP_SIZE])
+    YsurfaceArray = -1 * tf.transpose(XsurfaceArray) #put -1 in the bottom of the table
+    XsurfaceArray = tf.expand_dims(XsurfaceArray, axis = -1)
+    YsurfaceArray = tf.expand_dims(YsurfaceArray, axis = -1)
 
-        surfaceArray = tf.concat([XsurfaceArray, YsurfaceArray, tf.zeros([CROP_SIZE, CROP_SIZE,1], dtype=tf.float32)], axis=-1)
-        surfaceArray = tf.expand_dims(surfaceArray, axis = 0) #Add dimension to support batch size
+    surfaceArray = tf.concat([XsurfaceArray, YsurfaceArray, tf.zeros([CROP_SIZE, CROP_SIZE,1], dtype=tf.float32)], axis=-1)
+    surfaceArray = tf.expand_dims(surfaceArray, axis = 0) #Add dimension to support batch size
+    return surfaceArray
 
-    with tf.variable_scope("generator", reuse=reuse_bool) as scope:
-        out_channels = 9
-        outputs = create_generator(inputs, out_channels) 
-        
+#Generator outputs [batch, width, height, 9] => svbrdf [batch, width, height, 12] : normals, diffuse, roughness, specular.
+def reconstruct_outputs(outputs):
     partialOutputedNormals = outputs[:,:,:,0:2]
     outputedDiffuse = outputs[:,:,:,2:5]
     outputedRoughness = outputs[:,:,:,5]
@@ -496,7 +759,63 @@ def create_model(inputs, targets, reuse_bool = False):
     
     normNormals = tf_Normalize(tf.concat([partialOutputedNormals, tmpNormals], axis = -1))
     outputedRoughnessExpanded = tf.expand_dims(outputedRoughness, axis = -1)
-    reconstructedOutputs =  tf.concat([normNormals, outputedDiffuse, outputedRoughnessExpanded, outputedRoughnessExpanded, outputedRoughnessExpanded, outputedSpecular], axis=-1)
+    return tf.concat([normNormals, outputedDiffuse, outputedRoughnessExpanded, outputedRoughnessExpanded, outputedRoughnessExpanded, outputedSpecular], axis=-1)
+
+#Mean absolute difference per image of each of the 4 maps between two svbrdfs, [batch, 4].
+def svbrdf_map_delta(svbrdf, referenceSvbrdf):
+    difference = tf.abs(svbrdf - referenceSvbrdf)
+    return tf.stack([tf.reduce_mean(difference[..., 3 * mapId:3 * mapId + 3], axis = [1, 2, 3]) for mapId in range(4)], axis = -1)
+
+#Per image test metrics of utils.metrics between two svbrdfs, {name: [batch]}.
+#The renderings use lightSet (see utils.metrics.metric_light_set) one configuration at a time, so only one rendering per image is in memory.
+def tf_test_metrics(outputs, targets, lightSet):
+    outputs = tf.cast(outputs, tf.float32)
+    targets = tf.cast(targets, tf.float32)
+    surfaceArray = tf_surfaceArray()
+    def renderingError(lightId):
+        errors = []
+        for kind, includeDiffuse in [("diffuse", True), ("specular", args.includeDiffuse)]:
+            wi, wo = tf_lightBankDirections(lightSet, lightId, kind, surfaceArray)
+            renderedTargets, renderedOutputs = tf_RenderBatched(targets, outputs, wi, wo, includeDiffuse = includeDiffuse)
+            errors.append(tf.reduce_mean(tf.abs(tf_renderingLog(renderedTargets) - tf_renderingLog(renderedOutputs)), axis = [0, 2, 3, 4]))
+        return (errors[0] + errors[1]) / 2.0
+    nbLights = len(lightSet["diffuseLights"])
+    rendering = tf.reduce_mean(tf.map_fn(renderingError, tf.range(nbLights), dtype = tf.float32, parallel_iterations = 1), axis = 0)
+
+    epsilon = 0.001
+    cosines = tf.reduce_sum(tf_Normalize(outputs[..., 0:3]) * tf_Normalize(targets[..., 0:3]), axis = -1)
+    normalAngle = tf.reduce_mean(tf.acos(tf.clip_by_value(cosines, -1.0, 1.0)), axis = [1, 2]) * (180.0 / math.pi)
+    def logL1(channels):
+        return tf.reduce_mean(tf.abs(tf.log(epsilon + deprocess(targets[..., channels])) - tf.log(epsilon + deprocess(outputs[..., channels]))), axis = [1, 2, 3])
+    roughness = tf.reduce_mean(tf.abs(deprocess(targets[..., 6:7]) - deprocess(outputs[..., 6:7])), axis = [1, 2, 3])
+    metrics = {"rendering": rendering, "normal_angle": normalAngle, "diffuse_log_l1": logL1(slice(3, 6)), "specular_log_l1": logL1(slice(9, 12)), "roughness_l1": roughness}
+    return {name: metrics[name] for name in METRIC_NAMES}
+
+#lightBank, lightBankIndices and lightBankRenderings replace the random renderings of the ground truth by the ones made by the input pipeline (see light_bank_dataset).
+def create_model(inputs, targets, reuse_bool = False, lightBank = None, lightBankIndices = None, lightBankRenderings = None):
+    batchSize = tf.shape(inputs)[0]
+    surfaceArray=[]
+    if args.loss == "render" or args.loss == "renderL2":
+        surfaceArray = tf_surfaceArray()
+
+    with tf.variable_scope("generator", reuse=reuse_bool) as scope:
+        out_channels = 9
+        outputs = create_generator(inputs, out_channels) 
+        
+    reconstructedOutputs = reconstruct_outputs(outputs)
+
+    if targets is None:
+        #Inference only, there is nothing to compare the outputs to.
+        return Model(
+            gen_loss_L1_exact=None,
+            gen_loss_L1=None,
+            gen_grads_and_vars=None,
+            outputs=reconstructedOutputs,
+            train=None,
+            rerendered=None,
+            gradient_feeds=None,
+            accumulate=None
+        )
 
     with tf.name_scope("generator_loss"):
         gen_loss_L1 = 0
@@ -526,38 +845,63 @@ def create_model(inputs, targets, reuse_bool = False):
 
             gen_loss_L1 = tf.reduce_mean(NormalL1 + DiffuseL1 + SpecularL1 + RoughnessL1)        
         elif args.loss == "render" or args.loss == "renderL2":
+            #The renderings are computed in the --precision dtype, the log terms and the loss in float32.
+            targets = tf.cast(targets, compute_dtype())
+            outputs = tf.cast(outputs, compute_dtype())
             with tf.name_scope("renderer"):
-                with tf.name_scope("diffuse"):
-                    for nbDiffuseRender in range(args.nbDiffuseRendering):
-                        diffuses = tf_generateDiffuseRendering(batchSize, targets, outputs)
-                        renderedDiffuseImages.append(diffuses[0][0])
-                        renderedDiffuseImagesOutputs.append(diffuses[1][0]) 
-                                                
-                with tf.name_scope ("specular"):
-                    for nbspecularRender in range(args.nbSpecularRendering):
-                        speculars = tf_generateSpecularRendering(batchSize, surfaceArray, targets, outputs)
-                        renderedSpecularImages.append(speculars[0][0])
-                        renderedSpecularImagesOutputs.append(speculars[1][0]) 
-                        
-                        
-                # renderedDiffuseImages contains X (3 by default) renderings of shape [batch_size, 256,256,3]
-                rerenderedTargets = renderedDiffuseImages[0]
-                for renderingDiff in renderedDiffuseImages[1:]:
-                    rerenderedTargets = tf.concat([rerenderedTargets, renderingDiff], axis = -1)
-                for renderingSpecu in renderedSpecularImages:
-                    rerenderedTargets = tf.concat([rerenderedTargets, renderingSpecu], axis = -1)
-
-                rerenderedOutputs = renderedDiffuseImagesOutputs[0]
-                for renderingOutDiff in renderedDiffuseImagesOutputs[1:]:
-                    rerenderedOutputs = tf.concat([rerenderedOutputs, renderingOutDiff], axis = -1)
-                for renderingOutSpecu in renderedSpecularImagesOutputs:
-                    rerenderedOutputs = tf.concat([rerenderedOutputs, renderingOutSpecu], axis = -1)               
+                if lightBankRenderings is not None:
+                    renderedTargets = tf.transpose(lightBankRenderings, [1, 0, 2, 3, 4])
+                    indices = tf.transpose(lightBankIndices) #[nbRenderings, batch]
+                    lightBankSize = len(lightBank["diffuseLights"])
+                    renderedOutputs = tf_renderLightBank(outputs, lightBank, indices[:args.nbDiffuseRendering], indices[args.nbDiffuseRendering:] - lightBankSize, surfaceArray)
+                    #Only evaluated if fetched.
+                    rerenderedTargets = renderings_to_channels(renderedTargets)
+                    rerenderedOutputs = renderings_to_channels(renderedOutputs)
+                elif args.renderImplementation == "chunked":
+                    renderedTargets, renderedOutputs = None, None
+                    gen_loss_chunked = tf_chunkedRenderingLoss(batchSize, surfaceArray, targets, outputs)
+                elif args.renderImplementation == "batched":
+                    # renderedTargets contains all the renderings stacked : [nbRenderings, batch_size, 256,256,3]
+                    renderedTargets, renderedOutputs = tf_generateBatchedRenderings(batchSize, surfaceArray, targets, outputs)
+                    #Only evaluated if fetched.
+                    rerenderedTargets = renderings_to_channels(renderedTargets)
+                    rerenderedOutputs = renderings_to_channels(renderedOutputs)
+                else:
+                    with tf.name_scope("diffuse"):
+                        for nbDiffuseRender in range(args.nbDiffuseRendering):
+                            diffuses = tf_generateDiffuseRendering(batchSize, targets, outputs)
+                            renderedDiffuseImages.append(diffuses[0][0])
+                            renderedDiffuseImagesOutputs.append(diffuses[1][0]) 
+                                                    
+                    with tf.name_scope ("specular"):
+                        for nbspecularRender in range(args.nbSpecularRendering):
+                            speculars = tf_generateSpecularRendering(batchSize, surfaceArray, targets, outputs)
+                            renderedSpecularImages.append(speculars[0][0])
+                            renderedSpecularImagesOutputs.append(speculars[1][0]) 
+                            
+                            
+                    # renderedDiffuseImages contains X (3 by default) renderings of shape [batch_size, 256,256,3]
+                    rerenderedTargets = renderedDiffuseImages[0]
+                    for renderingDiff in renderedDiffuseImages[1:]:
+                        rerenderedTargets = tf.concat([rerenderedTargets, renderingDiff], axis = -1)
+                    for renderingSpecu in renderedSpecularImages:
+                        rerenderedTargets = tf.concat([rerenderedTargets, renderingSpecu], axis = -1)
+
+                    rerenderedOutputs = renderedDiffuseImagesOutputs[0]
+                    for renderingOutDiff in renderedDiffuseImagesOutputs[1:]:
+                        rerenderedOutputs = tf.concat([rerenderedOutputs, renderingOutDiff], axis = -1)
+                    for renderingOutSpecu in renderedSpecularImagesOutputs:
+                        rerenderedOutputs = tf.concat([rerenderedOutputs, renderingOutSpecu], axis = -1)               
+                    renderedTargets, renderedOutputs = rerenderedTargets, rerenderedOutputs
 
                 gen_loss_L1 = 0
-                if args.loss == "render":
-                    gen_loss_L1 = tf.reduce_mean(tf.abs(tf.log(rerenderedTargets + 0.01) - tf.log(rerenderedOutputs + 0.01)))
-                if args.loss == "renderL2":
-                    gen_loss_L1 = tf.reduce_mean(tf.square(tf.log(rerenderedTargets + 0.01) - tf.log(rerenderedOutputs + 0.01)))
+                if renderedTargets is None:
+                    #named like the reduce_mean of the other implementations, so the moving average of the loss has the same variable name in the checkpoints.
+                    gen_loss_L1 = tf.identity(gen_loss_chunked, name="Mean")
+                elif args.loss == "render":
+                    gen_loss_L1 = tf.reduce_mean(tf.abs(tf_renderingLog(renderedTargets) - tf_renderingLog(renderedOutputs)))
+                elif args.loss == "renderL2":
+                    gen_loss_L1 = tf.reduce_mean(tf.square(tf_renderingLog(renderedTargets) - tf_renderingLog(renderedOutputs)))
         consistencyLoss = 0
                     
         gen_loss = gen_loss_L1 * args.l1_weight
@@ -567,19 +911,42 @@ def create_model(inputs, targets, reuse_bool = False):
             gen_tvars = [var for var in tf.trainable_variables() if var.name.startswith("generator")]
             gen_optim = tf.train.AdamOptimizer(args.lr, args.beta1)
             gen_grads_and_vars = gen_optim.compute_gradients(gen_loss_L1, var_list=gen_tvars)
-            gen_train = gen_optim.apply_gradients(gen_grads_and_vars)
+            gradient_feeds = None
+            accumulate = None
+            if args.accumulateSteps > 1 and not reuse_bool:
+                #Each micro-batch adds its gradients to the accumulators (accumulate), train applies their average and resets them.
+                #The accumulators are local variables and gen_loss_L1 is fed with the mean loss of the micro-batches when applying (see run_accumulated_step),
+                #so the checkpoints have the same variables with and without accumulation.
+                gen_grads_and_vars = [(grad, var) for grad, var in gen_grads_and_vars if grad is not None]
+                accumulators = [tf.Variable(tf.zeros(var.shape, var.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="gradient_accumulator") for grad, var in gen_grads_and_vars]
+                accumulate = tf.group(*[accumulator.assign_add(grad) for accumulator, (grad, var) in zip(accumulators, gen_grads_and_vars)])
+                gen_train = gen_optim.apply_gradients([(accumulator / args.accumulateSteps, var) for accumulator, (grad, var) in zip(accumulators, gen_grads_and_vars)])
+            elif args.workers > 1 and not reuse_bool:
+                #The gradients are averaged between the workers outside of the graph (see run_worker_step) and fed back to be applied.
+                #So is the loss : gen_loss_L1 is fed with the average, its moving average keeps the name of the single process one.
+                gen_grads_and_vars = [(grad, var) for grad, var in gen_grads_and_vars if grad is not None]
+                gradient_feeds = [tf.placeholder(grad.dtype, grad.shape) for grad, var in gen_grads_and_vars]
+                gen_train = gen_optim.apply_gradients(zip(gradient_feeds, [var for grad, var in gen_grads_and_vars]))
+            else:
+                gen_train = gen_optim.apply_gradients(gen_grads_and_vars)
 
     ema = tf.train.ExponentialMovingAverage(decay=0.99)
     update_losses = ema.apply([gen_loss_L1])
     global_step = tf.train.get_or_create_global_step()
     incr_global_step = tf.assign(global_step, global_step+1)
+    train = tf.group(update_losses, incr_global_step, gen_train)
+    if accumulate is not None:
+        with tf.control_dependencies([train]):
+            train = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators])
     return Model(
         gen_loss_L1_exact=gen_loss_L1,
         gen_loss_L1=ema.average(gen_loss_L1),
         gen_grads_and_vars=gen_grads_and_vars,
         outputs=outputs,
-        train=tf.group(update_losses, incr_global_step, gen_train),
-        rerendered = [rerenderedTargets,rerenderedOutputs]
+        train=train,
+        rerendered = [rerenderedTargets,rerenderedOutputs],
+        gradient_feeds=gradient_feeds,
+        accumulate=accumulate
     )
     
 def save_loss_value(values):
@@ -608,6 +975,8 @@ def save_images(fetches, output_dir = args.output_dir, step=None):
             f.write(contents)
         #fetch outputs and targets
         for kind in ["outputs", "targets"]:
+            if not kind in fetches:
+                continue
             for idImage in range(args.nbTargets):
                 filename = name + "-" + kind + "-" + str(idImage) + "-.png"
                 if step is not None:
@@ -623,67 +992,84 @@ def save_images(fetches, output_dir = args.output_dir, step=None):
     return filesets
 
 
-def append_index(filesets, output_dir = args.output_dir, step=False):
-    index_path = os.path.join(output_dir, "index.html")
-    if os.path.exists(index_path):
-        index = open(index_path, "a")
-    else:
-        mapnames = ["normals", "diffuse", "roughness", "log(specular)"]
-        index = open(index_path, "w")
-        index.write("<html><body><table><tr>")
-        if step:
-            index.write("<th>step</th>")
-        index.write("<th>name</th><th>log(input)</th>")
-        for idImage in range(args.nbTargets):
-            index.write("<th>" + str(mapnames[idImage]) + "</th>")
-        index.write("</tr>")            
-
-    for fileset in filesets:
-        index.write("<tr>")
-
-        if step:
-            index.write("<td>%d</td>" % fileset["step"])
-        index.write("<td>%s targets</td>" % fileset["name"])
-        if args.mode != "eval" : 
-
-            for kind in ["inputs", "targets"]:
-                if kind == "inputs":
-                    index.write("<td><img src='images/%s'></td>" % fileset[kind])
-                elif kind == "targets":
-                    for idImage in range(args.nbTargets):
-                        filetsetKey = kind + str(idImage)
-                        index.write("<td><img src='images/%s'></td>" % fileset[filetsetKey])
-            index.write("</tr>")
-            index.write("<tr>")
-
-        if step:
-            index.write("<td></td>")
-        index.write("<td>outputs</td>")
-        for kind in ["inputs", "outputs"]:
-            if kind == "inputs":
-                index.write("<td><img src='images/%s'></td>" % fileset[kind])
-            elif kind=="outputs":
+#Accuracy delta of --precision against float32, in the [-1, 1] output space, printed and written to precision.json.
+def save_precision_report(deltas, output_dir = args.output_dir):
+    report = {"precision": args.precision, "images": len(deltas), "mean_abs_delta": {}, "worst_image_abs_delta": {}}
+    for mapId, mapName in enumerate(["normals", "diffuse", "roughness", "specular"]):
+        report["mean_abs_delta"][mapName] = float(np.mean(deltas[:, mapId]))
+        report["worst_image_abs_delta"][mapName] = float(np.max(deltas[:, mapId]))
+        print("%s vs float32 %s : mean abs delta %.5f, worst image %.5f" % (args.precision, mapName, report["mean_abs_delta"][mapName], report["worst_image_abs_delta"][mapName]))
+    with open(os.path.join(output_dir, "precision.json"), "w") as f:
+        f.write(json.dumps(report, sort_keys=True, indent=4))
+
+
+#Adds the saved images of a batch to report, the fetched uint8 images are used for the thumbnails.
+def report_filesets(report, filesets, fetches):
+    for i, fileset in enumerate(filesets):
+        images = {"inputs": fetches["input_images"][i]}
+        for kind in ["outputs", "targets"]:
+            if kind + "_images" in fetches:
                 for idImage in range(args.nbTargets):
-                    filetsetKey = kind + str(idImage)
-                    index.write("<td><img src='images/%s'></td>" % fileset[filetsetKey])
-        index.write("</tr>")
-    
-    return index_path
+                    images[kind + str(idImage)] = fetches[kind + "_images"][i * args.nbTargets + idImage]
+        report.add(fileset, images)
 
 def runTestFromTrain(currentStep, evalExamples, max_steps, display_fetches_test, sess):
-    #sess.run(evalExamples.iterator.initializer)
+    #the evaluation set is read once per test, starting from its first example.
+    sess.run(evalExamples.iterator.initializer)
     max_steps = min(evalExamples.steps_per_epoch, max_steps)
-    for step in range(max_steps):
-        try:
-            results_test = sess.run(display_fetches_test)
-            test_output_dir = args.output_dir + "/testStep"+str(currentStep)
-            filesets = save_images(results_test, test_output_dir)
-            index_path = append_index(filesets, test_output_dir)
-        except tf.errors.OutOfRangeError:
-            print("error in the runTestFromTrain of OutOfRangeError")
-            continue;    
-    print("wrote index at", index_path)
+    test_output_dir = args.output_dir + "/testStep"+str(currentStep)
+    report = ResultsReport(test_output_dir, args.nbTargets, True, args.reportPageSize)
+    def write_results(results_test):
+        filesets = save_images(results_test, test_output_dir)
+        report_filesets(report, filesets, results_test)
+    #the images of a batch are written while the next one is evaluated.
+    with AsyncWriter(args.writerQueue) as writer:
+        for step in range(max_steps):
+            try:
+                writer.submit(write_results, sess.run(display_fetches_test))
+            except tf.errors.OutOfRangeError:
+                break
+    print("wrote index at", report.close())
     
+def convert(image, squeeze=False):
+    if args.aspect_ratio != 1.0:
+        # upscale to correct aspect ratio
+        size = [CROP_SIZE, int(round(CROP_SIZE * args.aspect_ratio))]
+        image = tf.image.resize_images(image, size=size, method=tf.image.ResizeMethod.BICUBIC)
+
+    if squeeze:
+        def tempLog(imageValue):                    
+            imageValue= tf.log(imageValue + 0.01)
+            imageValue = imageValue - tf.reduce_min(imageValue)
+            imageValue = imageValue / tf.reduce_max(imageValue)
+            return imageValue
+        image = [tempLog(imageVal) for imageVal in image]
+
+    return tf.image.convert_image_dtype(image, dtype=tf.uint8, saturate=True)
+
+#The evaluation set of a training, next to its input_dir.
+def test_input_dir():
+    return args.input_dir.rsplit('\\',1)[0] + "\\testBlended"
+
+#Png and uint8 images of the evaluation set for runTestFromTrain.
+def create_test_fetches(evalExamples, outputs):
+    with tf.name_scope("test_images"):
+        inputs_reshaped = reshape_tensor_display(deprocess(evalExamples.inputs), 1, logAlbedo = False)
+        targets_reshaped = reshape_tensor_display(deprocess(evalExamples.targets), args.nbTargets, logAlbedo = args.logOutputAlbedos)
+        outputs_reshaped = reshape_tensor_display(deprocess(outputs), args.nbTargets, logAlbedo = args.logOutputAlbedos)
+        converted_inputs = convert(inputs_reshaped)
+        converted_targets = convert(targets_reshaped)
+        converted_outputs = convert(outputs_reshaped)
+        return {
+            "paths": evalExamples.paths,
+            "inputs": tf.map_fn(tf.image.encode_png, converted_inputs, dtype=tf.string, name="input_pngs"),
+            "targets": tf.map_fn(tf.image.encode_png, converted_targets, dtype=tf.string, name="target_pngs"),
+            "outputs": tf.map_fn(tf.image.encode_png, converted_outputs, dtype=tf.string, name="output_pngs"),
+            "input_images": converted_inputs,
+            "target_images": converted_targets,
+            "output_images": converted_outputs,
+        }
+
 def reshape_tensor_display(tensor, splitAmount, logAlbedo = False):
     tensors_list = tf.split(tensor, splitAmount, axis=3)#4 * [batch, 256,256,3]
     if logAlbedo:
@@ -696,25 +1082,251 @@ def reshape_tensor_display(tensor, splitAmount, logAlbedo = False):
     tensors_reshaped = tf.reshape(tensors, newShape)
     #print(tensors_reshaped.get_shape()) 
     return tensors_reshaped
+
+#High resolution eval graph. The statistics read by the normalizations and the global network are computed once per picture on its CROP_SIZE downsample,
+#the generator then runs on batches of full resolution tiles fed with these statistics so that every tile sees the same material context.
+def create_tiled_inference():
+    path = tf.placeholder(tf.string, [])
+    image = _prepare_input(_decode_image(tf.read_file(path)), resize = False)
+    input_image = tf.image.convert_image_dtype(deprocess(image), dtype=tf.uint8, saturate=True)
+    input_png = tf.image.encode_png(input_image)
+    statistics = []
+    with tf.variable_scope("generator"):
+        create_generator(tf.expand_dims(tf.image.resize_images(image, [CROP_SIZE, CROP_SIZE], method=tf.image.ResizeMethod.AREA), axis = 0), 9, recordStatistics = statistics)
+
+    #Only the tile generator runs per batch : the statistics are fed with their values, which cuts the graph above them.
+    tiles = tf.placeholder(tf.float32, [None, args.tileSize, args.tileSize, 3])
+    with tf.variable_scope("generator", reuse=True):
+        outputs = reconstruct_outputs(create_generator(tiles, 9, statistics = statistics))
+
+    #Blended rows [nbRows, width, 12] => nbTargets uint8 maps [nbRows, width, 3].
+    rows = tf.placeholder(tf.float32, [None, None, 12])
+    with tf.name_scope("convert_outputs"):
+        maps = reshape_tensor_display(deprocess(tf.expand_dims(rows, axis = 0)), args.nbTargets, logAlbedo = args.logOutputAlbedos)
+        maps = tf.image.convert_image_dtype(maps, dtype=tf.uint8, saturate=True)
+    mapImage = tf.placeholder(tf.uint8, [None, None, 3])
+    return TiledInference(path=path, image=image, input_image=input_image, input_png=input_png, statistics=statistics, tiles=tiles, outputs=outputs, rows=rows, maps=maps, map=mapImage, map_png=tf.image.encode_png(mapImage))
+
+def run_tiled_eval(flatPathList):
+    if args.tileSize % CROP_SIZE != 0:
+        raise Exception("--tileSize must be a multiple of %d" % CROP_SIZE)
+    if args.tileOverlap < 0 or args.tileOverlap >= args.tileSize:
+        raise Exception("--tileOverlap must be in [0, tileSize)")
+    if args.outputFormat == "memmap":
+        raise Exception("--outputFormat memmap needs pictures of a single size, use npy or exr with --tileSize")
+    if isinstance(flatPathList, MaterialSampler):
+        flatPathList = list(flatPathList())
+    inference = create_tiled_inference()
+    saver = tf.train.Saver([var for var in tf.global_variables() if var.name.startswith("generator")])
+
+    image_dir = os.path.join(args.output_dir, "images")
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+    #other formats than png get the blended linear maps in [0, 1], without any 8 bit conversion.
+    pngOutputs = args.outputFormat == "png"
+    report = None
+    mapWriter = None
+    if pngOutputs:
+        report = ResultsReport(args.output_dir, args.nbTargets, False, args.reportPageSize)
+    else:
+        mapWriter = create_map_writer(args.outputFormat, args.output_dir, len(flatPathList), None, args.outputDtype)
+    with tf.Session() as sess:
+        print("loading model from checkpoint : " + args.checkpoint)
+        saver.restore(sess, tf.train.latest_checkpoint(args.checkpoint))
+        for path in flatPathList:
+            results = sess.run({"image": inference.image, "input_image": inference.input_image, "input_png": inference.input_png, "statistics": inference.statistics}, feed_dict={inference.path: path})
+            statisticsFeed = {}
+            for layerStatistics, layerValues in zip(inference.statistics, results["statistics"]):
+                statisticsFeed.update(zip(layerStatistics, layerValues))
+            height, width = results["image"].shape[:2]
+            if pngOutputs:
+                maps = np.zeros([args.nbTargets, height, width, 3], dtype=np.uint8)
+            else:
+                maps = np.zeros([height, width, 12], dtype=args.outputDtype)
+
+            def finish(y, rows):
+                #the blended normals are normalized again.
+                rows[..., 0:3] /= np.maximum(np.linalg.norm(rows[..., 0:3], axis = -1, keepdims = True), 1e-8)
+                if pngOutputs:
+                    maps[:, y:y + len(rows)] = sess.run(inference.maps, feed_dict={inference.rows: rows})
+                else:
+                    maps[y:y + len(rows)] = (rows + 1) / 2
+
+            blender = BandBlender(height, width, 12, args.tileSize, args.tileOverlap, finish)
+            nbTiles = 0
+            for tiles, positions in tile_batches(pad_to_tile(results["image"], args.tileSize), args.tileSize, args.tileOverlap, args.tileBatch):
+                statisticsFeed[inference.tiles] = tiles
+                outputs = sess.run(inference.outputs, feed_dict=statisticsFeed)
+                for tile, (y, x) in zip(outputs, positions):
+                    blender.add(tile, y, x)
+                nbTiles += len(tiles)
+            blender.close()
+
+            name, _ = os.path.splitext(os.path.basename(path))
+            if mapWriter is not None:
+                mapWriter.write([path.encode("utf8")], maps[np.newaxis])
+                print("evaluated image", name, "%dx%d" % (width, height), "in", nbTiles, "tiles")
+                continue
+            fileset = {"name": name, "step": None, "inputs": name + "-inputs.png"}
+            images = {"inputs": results["input_image"]}
+            with open(os.path.join(image_dir, fileset["inputs"]), "wb") as f:
+                f.write(results["input_png"])
+            for idImage in range(args.nbTargets):
+                fileset["outputs" + str(idImage)] = name + "-outputs-" + str(idImage) + "-.png"
+                images["outputs" + str(idImage)] = maps[idImage]
+                with open(os.path.join(image_dir, fileset["outputs" + str(idImage)]), "wb") as f:
+                    f.write(sess.run(inference.map_png, feed_dict={inference.map: maps[idImage]}))
+            report.add(fileset, images)
+            print("evaluated image", name, "%dx%d" % (width, height), "in", nbTiles, "tiles")
+    if mapWriter is not None:
+        mapWriter.close()
+    else:
+        print("wrote index at", report.close())
+
+#Writes the generator with its weights as constants, for utils.frozen. The input is a float [batch, height, width, 3] picture in [0, 1] named EXPORT_INPUT,
+#prepared like the eval inputs (gamma, log, resize), the outputs are the 4 maps in [0, 1], [batch, CROP_SIZE, CROP_SIZE, 3] tensors named after EXPORT_OUTPUTS.
+def export_frozen_graph():
+    image = tf.placeholder(tf.float32, [None, None, None, 3], name=EXPORT_INPUT)
+    with tf.variable_scope("generator"):
+        outputs = reconstruct_outputs(create_generator(_prepare_input(image), 9))
+    for mapName, mapImage in zip(EXPORT_OUTPUTS, tf.split(deprocess(outputs), len(EXPORT_OUTPUTS), axis = -1)):
+        tf.identity(mapImage, name=mapName)
+
+    saver = tf.train.Saver([var for var in tf.global_variables() if var.name.startswith("generator")])
+    with tf.Session() as sess:
+        print("loading model from checkpoint : " + args.checkpoint)
+        saver.restore(sess, tf.train.latest_checkpoint(args.checkpoint))
+        #keeps only what the outputs depend on, with the variables folded into constants.
+        graphDef = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), EXPORT_OUTPUTS)
+    graphDef = tf.graph_util.remove_training_nodes(graphDef, protected_nodes=[EXPORT_INPUT] + EXPORT_OUTPUTS)
+
+    with open(os.path.join(args.output_dir, FROZEN_GRAPH), "wb") as f:
+        f.write(graphDef.SerializeToString())
+    manifest = {"graph": FROZEN_GRAPH, "input": EXPORT_INPUT, "outputs": EXPORT_OUTPUTS, "scale_size": CROP_SIZE, "checkpoint": tf.train.latest_checkpoint(args.checkpoint)}
+    for key in ["correctGamma", "useLog", "precision", "fusedNorm", "subpixelDecoder"]:
+        manifest[key] = getattr(args, key)
+    with open(os.path.join(args.output_dir, EXPORT_MANIFEST), "w") as f:
+        f.write(json.dumps(manifest, sort_keys=True, indent=4))
+    print("exported", len(graphDef.node), "nodes to", os.path.join(args.output_dir, FROZEN_GRAPH))
+
+#Serving graph : a batch of encoded pictures [batch] is decoded and prepared like the eval inputs, the 4 maps are returned PNG encoded, [batch] strings each.
+def create_serving_graph():
+    pictures = tf.placeholder(tf.string, [None])
+    inputs = tf.map_fn(lambda picture: _prepare_input(_decode_image(picture)), pictures, dtype=tf.float32)
+    with tf.variable_scope("generator"):
+        outputs = reconstruct_outputs(create_generator(inputs, 9))
+    pngs = {}
+    with tf.name_scope("encode_images"):
+        for mapName, mapImage in zip(EXPORT_OUTPUTS, tf.split(deprocess(outputs), len(EXPORT_OUTPUTS), axis = -1)):
+            mapImage = tf.image.convert_image_dtype(mapImage, dtype=tf.uint8, saturate=True)
+            pngs[mapName] = tf.map_fn(tf.image.encode_png, mapImage, dtype=tf.string, name=mapName + "_pngs")
+    return pictures, pngs
+
+#Keeps one session warm and serves it over HTTP, concurrent requests are run together (see utils.server).
+def run_server():
+    pictures, pngs = create_serving_graph()
+    saver = tf.train.Saver([var for var in tf.global_variables() if var.name.startswith("generator")])
+    sess = tf.Session()
+    print("loading model from checkpoint : " + args.checkpoint)
+    saver.restore(sess, tf.train.latest_checkpoint(args.checkpoint))
+
+    def run_batch(batch):
+        try:
+            results = sess.run(pngs, feed_dict={pictures: batch})
+        except tf.errors.InvalidArgumentError as error:
+            raise ValueError("could not decode the picture : " + error.message)
+        return [{mapName: results[mapName][pictureId] for mapName in EXPORT_OUTPUTS} for pictureId in range(len(batch))]
+
+    #the first run pays for the graph optimizations and the allocations, not the first request.
+    run_batch([sess.run(tf.image.encode_png(tf.zeros([CROP_SIZE, CROP_SIZE, 3], dtype=tf.uint8)))] * args.serveBatch)
+    serve(run_batch, args.host, args.port, args.serveBatch, args.serveLatency / 1000.0)
     
+#Training step of a worker of --workers : the gradients and the loss of its batch are averaged with the other workers before being applied.
+#fetches is the single worker step fetches, its train op is replaced by the gradients.
+def run_worker_step(allReduce, model, globalStep, sess, fetches, options, run_metadata):
+    fetches = dict(fetches)
+    del fetches["train"]
+    fetches["gradients"] = [grad for grad, var in model.gen_grads_and_vars]
+    fetches["loss"] = model.gen_loss_L1_exact
+    results = sess.run(fetches, options=options, run_metadata=run_metadata)
+    averaged = allReduce.allreduce(np.concatenate([np.ravel(grad) for grad in results["gradients"]] + [[results["loss"]]])) / allReduce.size
+    #feeding the loss tensor updates its moving average without reading another batch.
+    feed_dict = {model.gen_loss_L1_exact: averaged[-1]}
+    offset = 0
+    for gradientFeed, grad in zip(model.gradient_feeds, results["gradients"]):
+        feed_dict[gradientFeed] = averaged[offset:offset + grad.size].reshape(grad.shape)
+        offset += grad.size
+    sess.run(model.train, feed_dict=feed_dict)
+    results["global_step"] = sess.run(globalStep)
+    return results
+
+#Training step of --accumulateSteps : the first micro-batches are only accumulated, fetches are run with the last one, then the update is applied.
+def run_accumulated_step(model, globalStep, sess, fetches, options, run_metadata):
+    losses = []
+    for microStep in range(args.accumulateSteps - 1):
+        losses.append(sess.run([model.accumulate, model.gen_loss_L1_exact])[1])
+    fetches = dict(fetches)
+    fetches["train"] = model.accumulate
+    fetches["loss"] = model.gen_loss_L1_exact
+    results = sess.run(fetches, options=options, run_metadata=run_metadata)
+    losses.append(results["loss"])
+    #feeding the loss tensor updates its moving average with the mean of the micro-batches, without reading another batch.
+    sess.run(model.train, feed_dict={model.gen_loss_L1_exact: np.mean(losses)})
+    results["global_step"] = sess.run(globalStep)
+    return results
+
+#Gives every worker the variables of the first one, whether they were initialized or restored.
+def broadcast_variables(allReduce, sess):
+    variables = [var for var in tf.global_variables() if var.dtype.base_dtype == tf.float32]
+    values = sess.run(variables)
+    broadcast = allReduce.broadcast(np.concatenate([np.ravel(value) for value in values]))
+    offset = 0
+    for var, value in zip(variables, values):
+        var.load(broadcast[offset:offset + value.size].reshape(value.shape), sess)
+        offset += value.size
+
+#Evaluates the checkpoints of a running training (--mode watch, started by --backgroundTest) with its own session and thread budget.
+def run_watcher():
+    evalExamples = load_examples(test_input_dir(), False)
+    print("evaluation set count = %d" % evalExamples.count)
+    model_test = create_model(evalExamples.inputs, evalExamples.targets)
+    display_fetches_test = create_test_fetches(evalExamples, model_test.outputs)
+    saver = tf.train.Saver()
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.evalThreads, inter_op_parallelism_threads=args.evalThreads)
+    #the training holds most of the gpu memory already.
+    config.gpu_options.allow_growth = True
+    with tf.Session(config=config) as sess:
+        def evaluate(checkpoint):
+            try:
+                saver.restore(sess, checkpoint)
+            except (tf.errors.NotFoundError, tf.errors.DataLossError):
+                print("checkpoint", checkpoint, "was replaced before it could be evaluated")
+                return False
+            print("evaluating checkpoint", checkpoint)
+            runTestFromTrain(checkpoint.rsplit("-", 1)[-1], evalExamples, 2**32, display_fetches_test, sess)
+            return True
+        evaluated = watch_checkpoints(args.checkpoint, lambda: tf.train.latest_checkpoint(args.checkpoint), evaluate, args.watchInterval)
+    print("training done, evaluated %d checkpoints" % len(evaluated))
+
 def main():
 
     if args.seed is None:
         args.seed = random.randint(0, 2**31 - 1)
 
-    tf.set_random_seed(args.seed)
-    np.random.seed(args.seed)
-    random.seed(args.seed)
+    #the workers of --workers draw different crops and renderings, their variables come from the first one.
+    tf.set_random_seed(args.seed + args.workerRank)
+    np.random.seed(args.seed + args.workerRank)
+    random.seed(args.seed + args.workerRank)
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    if args.mode == "test" or args.mode == "export" or args.mode == "eval" :
+    if args.mode == "test" or args.mode == "export" or args.mode == "eval" or args.mode == "serve" :
         if args.checkpoint is None:
-            raise Exception("checkpoint required for test, export or eval mode")
+            raise Exception("checkpoint required for test, export, eval or serve mode")
 
         # load some options from the checkpoint
-        options = {"which_direction", "ngf", "ndf", "nbTargets", "depthFactor", "loss", "useLog"}
+        options = {"which_direction", "ngf", "ndf", "nbTargets", "depthFactor", "loss", "useLog", "subpixelDecoder"}
         with open(os.path.join(args.checkpoint, "options.json")) as f:
             for key, val in json.loads(f.read()).items():
                 if key in options:
@@ -724,112 +1336,165 @@ def main():
         args.scale_size = CROP_SIZE
         args.flip = False
 
+    if args.mode == "train" and args.subpixelDecoder:
+        raise Exception("--subpixelDecoder is for inference only, export a trained checkpoint with utils.subpixelExport")
+
     for k, v in args._get_kwargs():
         print(k, "=", v)
 
+    if args.mode == "watch":
+        #shares the output_dir (and options.json) of the training it evaluates.
+        if args.checkpoint is None:
+            raise Exception("checkpoint required for watch mode")
+        run_watcher()
+        return
+
     with open(os.path.join(args.output_dir, "options.json"), "w") as f:
         f.write(json.dumps(vars(args), sort_keys=True, indent=4))
 
-    examples = load_examples(args.input_dir, args.mode == "train")
+    if args.accumulateSteps < 1:
+        raise Exception("--accumulateSteps must be at least 1")
+    if args.mode == "train" and args.workers > 1:
+        if args.accumulateSteps > 1:
+            raise Exception("--accumulateSteps is not supported with --workers, use a larger batch per worker instead")
+        if args.workerRank < 0 or args.workerRank >= args.workers:
+            raise Exception("--workerRank must be between 0 and --workers - 1")
+        if args.workerRank == 0 and args.workerHosts is None:
+            spawn_local_workers(args.workers, args.output_dir, args.seed)
+    #only the first worker evaluates and writes checkpoints, summaries and images.
+    isChief = args.workerRank == 0
+    inlineTests = args.mode == "train" and isChief and not args.backgroundTest
+
+    if args.mode == "cache":
+        if args.cacheDir is None:
+            raise Exception("--cacheDir is required for cache mode")
+        write_cache(args.input_dir, args.cacheDir)
+        return
+
+    if args.mode == "export":
+        export_frozen_graph()
+        return
+
+    if args.mode == "serve":
+        run_server()
+        return
+
+    if args.tileSize > 0:
+        if args.mode != "eval":
+            raise Exception("--tileSize is only supported in eval mode")
+        if args.metrics:
+            raise Exception("--metrics needs the targets of test mode")
+        run_tiled_eval(readInputPaths(args.input_dir, False))
+        return
+
+    lightBank = None
+    if args.mode == "train" and args.lightBankSize > 0 and (args.loss == "render" or args.loss == "renderL2"):
+        if args.lightBankSize < max(args.nbDiffuseRendering, args.nbSpecularRendering):
+            raise Exception("--lightBankSize must be at least the number of diffuse and specular renderings")
+        if args.lightBankCache is not None and (args.cacheDir is not None or args.testMode == "xml"):
+            #the cache would freeze the first epoch's pairs and group order of the sampler, or the shard and example shuffles of --cacheDir.
+            raise Exception("--lightBankCache repeats the first epoch's examples in the same order, it cannot be used with the per epoch shuffles of an xml input_dir or of --cacheDir")
+        lightBank = load_or_create_light_bank(args.lightBankSize, args.seed, args.output_dir, args.checkpoint)
+
+    examples = load_examples(args.input_dir, args.mode == "train", args.cacheDir if args.mode == "train" else None, lightBank)
     print(args.mode + " set count = %d" % examples.count)
-    if args.mode == "train":
-        evalExamples = load_examples(args.input_dir.rsplit('\\',1)[0] + "\\testBlended", False)
+    if args.metrics and (args.mode != "test" or examples.targets is None):
+        raise Exception("--metrics needs the targets of test mode")
+    if inlineTests:
+        evalExamples = load_examples(test_input_dir(), False)
         print("evaluation set count = %d" % evalExamples.count)
 
     # inputs and targets are [batch_size, height, width, channels]
-    model = create_model(examples.inputs, examples.targets, False)
-    if args.mode == "train":
+    model = create_model(examples.inputs, examples.targets, False, lightBank, examples.bank_indices, examples.bank_renderings)
+    if inlineTests:
         model_test = create_model(evalExamples.inputs, evalExamples.targets, True)
+        display_fetches_test = create_test_fetches(evalExamples, model_test.outputs)
+    #float32 run of the same weights, to report the cost of the reduced precision on the test set. Opt-in as it runs the network twice.
+    precisionReport = args.mode == "test" and args.precisionReport and args.precision != "float32"
+    if precisionReport:
+        with tf.variable_scope("generator", reuse=True):
+            referenceOutputs = reconstruct_outputs(create_generator(examples.inputs, 9, "float32"))
 
     tmpTargets = examples.targets
-    if args.mode == "train":
-        tmpTargetsTest = evalExamples.targets
 
     # undo colorization splitting on images that we use for display/output    
     inputs = deprocess(examples.inputs)
-    targets = deprocess(tmpTargets)
+    if tmpTargets is not None:
+        targets = deprocess(tmpTargets)
     outputs = deprocess(model.outputs)
-    
-            
-    if args.mode == "train":
-        inputsTests = deprocess(evalExamples.inputs)
-        targetsTests = deprocess(tmpTargetsTest)
-        outputsTests = deprocess(model_test.outputs)
-
-    def convert(image, squeeze=False):
-        if args.aspect_ratio != 1.0:
-            # upscale to correct aspect ratio
-            size = [CROP_SIZE, int(round(CROP_SIZE * args.aspect_ratio))]
-            image = tf.image.resize_images(image, size=size, method=tf.image.ResizeMethod.BICUBIC)
-
-        if squeeze:
-            def tempLog(imageValue):                    
-                imageValue= tf.log(imageValue + 0.01)
-                imageValue = imageValue - tf.reduce_min(imageValue)
-                imageValue = imageValue / tf.reduce_max(imageValue)
-                return imageValue
-            image = [tempLog(imageVal) for imageVal in image]
-
-        return tf.image.convert_image_dtype(image, dtype=tf.uint8, saturate=True)
 
     with tf.name_scope("transform_images"):
-        targets_reshaped = reshape_tensor_display(targets, args.nbTargets, logAlbedo = args.logOutputAlbedos)
+        if tmpTargets is not None:
+            targets_reshaped = reshape_tensor_display(targets, args.nbTargets, logAlbedo = args.logOutputAlbedos)
         outputs_reshaped = reshape_tensor_display(outputs, args.nbTargets, logAlbedo = args.logOutputAlbedos)
         inputs_reshaped = reshape_tensor_display(inputs, 1, logAlbedo = False)
 
-        if args.mode == "train":
-            inputs_reshaped_test = reshape_tensor_display(inputsTests, 1, logAlbedo = False)
-            targets_test_reshaped = reshape_tensor_display(targetsTests, args.nbTargets, logAlbedo = args.logOutputAlbedos)
-            outputs_test_reshaped = reshape_tensor_display(outputsTests, args.nbTargets, logAlbedo = args.logOutputAlbedos)
-
-
     # reverse any processing on images so they can be written to disk or displayed to user
     with tf.name_scope("convert_inputs"):
         converted_inputs = convert(inputs_reshaped)
-        if args.mode == "train":
-            converted_inputs_test = convert(inputs_reshaped_test)
     with tf.name_scope("convert_targets"):
-        converted_targets = convert(targets_reshaped)
-        if args.mode == "train":
-            converted_targets_test = convert(targets_test_reshaped)
+        if tmpTargets is not None:
+            converted_targets = convert(targets_reshaped)
     with tf.name_scope("convert_outputs"):
         converted_outputs = convert(outputs_reshaped)
-        if args.mode == "train":
-            converted_outputs_test = convert(outputs_test_reshaped)
+    #Test and eval outputs other than png are the linear maps, fetched without any 8 bit conversion or encoding.
+    pngOutputs = args.mode == "train" or args.outputFormat == "png"
     with tf.name_scope("encode_images"):
         display_fetches = {
             "paths": examples.paths,
-            "inputs": tf.map_fn(tf.image.encode_png, converted_inputs, dtype=tf.string, name="input_pngs"),
-            "targets": tf.map_fn(tf.image.encode_png, converted_targets, dtype=tf.string, name="target_pngs"),
-            "outputs": tf.map_fn(tf.image.encode_png, converted_outputs, dtype=tf.string, name="output_pngs"),
         }
-        if args.mode == "train":
-            display_fetches_test = {
-                "paths": evalExamples.paths,
-                "inputs": tf.map_fn(tf.image.encode_png, converted_inputs_test, dtype=tf.string, name="input_pngs"),
-                "targets": tf.map_fn(tf.image.encode_png, converted_targets_test, dtype=tf.string, name="target_pngs"),
-                "outputs": tf.map_fn(tf.image.encode_png, converted_outputs_test, dtype=tf.string, name="output_pngs"),
-            }        
-            
+        if pngOutputs:
+            display_fetches["inputs"] = tf.map_fn(tf.image.encode_png, converted_inputs, dtype=tf.string, name="input_pngs")
+            display_fetches["outputs"] = tf.map_fn(tf.image.encode_png, converted_outputs, dtype=tf.string, name="output_pngs")
+            #the report thumbnails are made from these by the writer.
+            display_fetches["input_images"] = converted_inputs
+            display_fetches["output_images"] = converted_outputs
+        elif args.outputFormat != "none":
+            display_fetches["output_maps"] = tf.cast(outputs, tf.as_dtype(args.outputDtype))
+        elif not args.metrics:
+            #none writes nothing but the model still runs : only a scalar depending on the outputs is fetched.
+            display_fetches["outputs_sum"] = tf.reduce_sum(model.outputs)
+        if tmpTargets is not None and pngOutputs:
+            display_fetches["targets"] = tf.map_fn(tf.image.encode_png, converted_targets, dtype=tf.string, name="target_pngs")
+            display_fetches["target_images"] = converted_targets
+        if precisionReport:
+            display_fetches["precision_delta"] = svbrdf_map_delta(model.outputs, referenceOutputs)
+    if args.metrics:
+        with tf.name_scope("test_metrics"):
+            display_fetches["metrics"] = tf_test_metrics(model.outputs, tmpTargets, metric_light_set(args.metricLights))
     with tf.name_scope("outputs_summary"):
         tf.summary.image("outputs", converted_outputs, max_outputs=args.nbTargets)
 
-    tf.summary.scalar("generator_loss", model.gen_loss_L1)
+    if model.gen_loss_L1 is not None:
+        tf.summary.scalar("generator_loss", model.gen_loss_L1)
 
 
     with tf.name_scope("parameter_count"):
         parameter_count = tf.reduce_sum([tf.reduce_prod(tf.shape(v)) for v in tf.trainable_variables()])
 
-    saver = tf.train.Saver(max_to_keep=1)
+    #with a background evaluator, the previous checkpoint stays while it is restored.
+    saver = tf.train.Saver(max_to_keep=2 if args.mode == "train" and args.backgroundTest else 1)
+
+    allReduce = None
+    sessionConfig = None
+    if args.mode == "train" and args.workers > 1:
+        if args.workerHosts is None:
+            #the local workers share the cores.
+            threads = max(1, (os.cpu_count() or 1) // args.workers)
+            sessionConfig = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+        print("worker %d of %d, waiting for the other workers" % (args.workerRank, args.workers))
+        allReduce = RingAllReduce(args.workerRank, worker_addresses(args.workers, args.workerHosts, args.workerPort))
 
-    logdir = args.output_dir if ( args.summary_freq > 0) else None
+    logdir = args.output_dir if ( args.summary_freq > 0 and isChief) else None
     sv = tf.train.Supervisor(logdir=logdir, save_summaries_secs=0, saver=None)
-    with sv.managed_session() as sess:
+    with sv.managed_session(config=sessionConfig) as sess:
         print("parameter_count =", sess.run(parameter_count))
         if args.checkpoint is not None:
             print("loading model from checkpoint : " + args.checkpoint)
             checkpoint = tf.train.latest_checkpoint(args.checkpoint)
             saver.restore(sess, checkpoint)
+        if allReduce is not None:
+            broadcast_variables(allReduce, sess)
 
         max_steps = 2**32
         
@@ -848,31 +1513,71 @@ def main():
 
             max_steps = min(examples.steps_per_epoch, max_steps)
             print(max_steps)
-            for step in range(max_steps):
-                try:
-                    #display_fetches["rerenders"] = renders_fetches_test
-                    #display_fetches["gen_loss_L1_exact"] = model.gen_loss_L1_exact
-                    results = sess.run(display_fetches)
-                    #save_tensor_images(results["rerenders"], "rerenderings/", suffix = step)
-                    #L1Values.append(results["gen_loss_L1_exact"])
-                    filesets = save_images(results)
-                    for i, f in enumerate(filesets):
-                        print("evaluated image", f["name"])
-                    index_path = append_index(filesets)
-                except tf.errors.OutOfRangeError :
-                    print("testing fails in OutOfRangeError")
-                    continue;
+            precisionDeltas = []
+            mapWriter = None
+            report = None
+            if pngOutputs:
+                report = ResultsReport(args.output_dir, args.nbTargets, tmpTargets is not None, args.reportPageSize)
+            else:
+                mapWriter = create_map_writer(args.outputFormat, args.output_dir, examples.count, CROP_SIZE, args.outputDtype)
+            metricsWriter = None
+            if args.metrics:
+                metricsWriter = MetricsWriter(args.output_dir, details = {"checkpoint": checkpoint, "lights": args.metricLights})
+            def write_results(results):
+                if metricsWriter is not None:
+                    metricsWriter.add(results["paths"], results["metrics"])
+                if mapWriter is not None:
+                    for name in mapWriter.write(results["paths"], results.get("output_maps")):
+                        print("evaluated image", name)
+                    return
+                filesets = save_images(results)
+                for i, f in enumerate(filesets):
+                    print("evaluated image", f["name"])
+                report_filesets(report, filesets, results)
+            #the images of a batch are written while the next one is evaluated.
+            with AsyncWriter(args.writerQueue) as writer:
+                for step in range(max_steps):
+                    try:
+                        #display_fetches["rerenders"] = renders_fetches_test
+                        #display_fetches["gen_loss_L1_exact"] = model.gen_loss_L1_exact
+                        results = sess.run(display_fetches)
+                        #save_tensor_images(results["rerenders"], "rerenderings/", suffix = step)
+                        #L1Values.append(results["gen_loss_L1_exact"])
+                        writer.submit(write_results, results)
+                        if "precision_delta" in results:
+                            precisionDeltas.extend(results["precision_delta"])
+                    except tf.errors.OutOfRangeError :
+                        #every example was evaluated.
+                        break
+            if mapWriter is not None:
+                mapWriter.close()
+            if report is not None:
+                print("wrote index at", report.close())
+            if metricsWriter is not None:
+                summary = metricsWriter.close()
+                for name in METRIC_NAMES:
+                    print(name, "mean %.6g std %.6g" % (summary["metrics"][name]["mean"], summary["metrics"][name]["std"]))
+            if len(precisionDeltas) > 0:
+                save_precision_report(np.array(precisionDeltas))
         else:
+            displayReport = ResultsReport(args.output_dir, args.nbTargets, tmpTargets is not None, args.reportPageSize, showStep=True) if isChief else None
+            evaluator = None
+            if args.backgroundTest and isChief:
+                clear_training_done(args.output_dir)
+                evaluator = spawn_evaluator(args.output_dir, args.evalNice)
             try:
                 # training
                 start_time = time.time()
-                sess.run(evalExamples.iterator.initializer)
+                input_bound_steps = 0
                 for step in range(max_steps):
                     def should(freq):
                         return freq > 0 and ((step + 1) % freq == 0 or step == max_steps - 1)
 
                     options = None
                     run_metadata = None
+                    if args.profileMemory and should(args.progress_freq):
+                        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                        run_metadata = tf.RunMetadata()
 
                     fetches = {
                         "train": model.train,
@@ -882,47 +1587,70 @@ def main():
                     if should(args.progress_freq) or step == 0 or step == 1:
                         fetches["gen_loss_L1"] = model.gen_loss_L1
 
-                    if should(args.summary_freq):
+                    if examples.buffer_time is not None:
+                        fetches["buffer_time"] = examples.buffer_time
+
+                    if isChief and should(args.summary_freq):
                         fetches["summary"] = sv.summary_op
 
-                    if should(args.display_freq):
+                    if isChief and should(args.display_freq):
                         fetches["display"] = display_fetches
                         
                     try:    
-                        results = sess.run(fetches, options=options, run_metadata=run_metadata)
+                        if allReduce is not None:
+                            results = run_worker_step(allReduce, model, sv.global_step, sess, fetches, options, run_metadata)
+                        elif model.accumulate is not None:
+                            results = run_accumulated_step(model, sv.global_step, sess, fetches, options, run_metadata)
+                        else:
+                            results = sess.run(fetches, options=options, run_metadata=run_metadata)
                     except tf.errors.OutOfRangeError :
                         print("training fails in OutOfRangeError")
                         continue
                         
                     global_step = results["global_step"]
+                    if "buffer_time" in results and results["buffer_time"] < INPUT_BOUND_SECONDS:
+                        input_bound_steps += 1
 
-                    if should(args.summary_freq):
+                    if "summary" in results:
                         sv.summary_writer.add_summary(results["summary"], global_step)
 
-                    if should(args.display_freq):
+                    if "display" in results:
                         print("saving display images")
                         filesets = save_images(results["display"], step=global_step)
-                        append_index(filesets, step=True)
+                        report_filesets(displayReport, filesets, results["display"])
 
-                    if should(args.progress_freq):
+                    if isChief and should(args.progress_freq):
                         # global_step will have the correct step count if we resume from a checkpoint
                         train_epoch = math.ceil(global_step / examples.steps_per_epoch)
                         train_step = global_step - (train_epoch - 1) * examples.steps_per_epoch
-                        print("progress  epoch %d  step %d  image/sec %0.1f" % (train_epoch, train_step, global_step * args.batch_size / (time.time() - start_time)))
+                        print("progress  epoch %d  step %d  image/sec %0.1f" % (train_epoch, train_step, global_step * args.batch_size * args.workers * args.accumulateSteps / (time.time() - start_time)))
                         print("gen_loss_L1", results["gen_loss_L1"])
+                        if examples.buffer_time is not None:
+                            print("input bound steps %d / %d" % (input_bound_steps, step + 1))
+                        if run_metadata is not None:
+                            print_peak_memory(run_metadata, "render " + args.renderImplementation + " recomputeActivations " + str(args.recomputeActivations) + " batch " + str(args.batch_size))
 
-                    if should(args.save_freq):
+                    if isChief and should(args.save_freq):
                         print("saving model")
                         saver.save(sess, os.path.join(args.output_dir, "model"), global_step=sv.global_step)
-                    if should(args.test_freq) or global_step == 1:
+                    if inlineTests and (should(args.test_freq) or global_step == 1):
                         runTestFromTrain(global_step, evalExamples, max_steps, display_fetches_test, sess)
                         
                     if sv.should_stop():
                         break
             finally:
-                saver.save(sess, os.path.join(args.output_dir, "model"), global_step=sv.global_step)
-                sess.run(evalExamples.iterator.initializer)
-                runTestFromTrain("final", evalExamples, max_steps, display_fetches_test, sess)
+                if displayReport is not None:
+                    displayReport.close()
+                if allReduce is not None:
+                    allReduce.close()
+                if isChief:
+                    saver.save(sess, os.path.join(args.output_dir, "model"), global_step=sv.global_step)
+                if inlineTests:
+                    runTestFromTrain("final", evalExamples, max_steps, display_fetches_test, sess)
+                elif evaluator is not None:
+                    #the evaluator finishes the last checkpoint on its own.
+                    mark_training_done(args.output_dir)
+                    print("background evaluation runs as process", evaluator.pid)
                 
                 
 # Normalizes a tensor troughout the Channels dimension (BatchSize, Width, Height, Channels)
@@ -951,7 +1679,7 @@ def tf_render_diffuse_Substance(diffuse, specular):
 
 def tf_render_D_GGX_Substance(roughness, NdotH):
     alpha = tf.square(roughness)
-    underD = 1/tf.maximum(0.001, (tf.square(NdotH) * (tf.square(alpha) - 1.0) + 1.0))
+    underD = 1/tf.maximum((tf.square(NdotH) * (tf.square(alpha) - 1.0) + 1.0), 0.001)
     return (tf.square(alpha * underD)/math.pi)
     
 def tf_lampAttenuation(distance):
@@ -960,7 +1688,7 @@ def tf_lampAttenuation(distance):
 
 
 def tf_render_F_GGX_Substance(specular, VdotH):
-    sphg = tf.pow(2.0, ((-5.55473 * VdotH) - 6.98316) * VdotH);
+    sphg = tf.pow(tf.constant(2.0, VdotH.dtype), ((-5.55473 * VdotH) - 6.98316) * VdotH);
     return specular + (1.0 - specular) * sphg
     
 def tf_render_G_GGX_Substance(roughness, NdotL, NdotV):
@@ -976,14 +1704,19 @@ def squeezeValues(tensor, min, max):
 # svbdrf : (BatchSize, Width, Height, 4 * 3)
 # wo : (BatchSize,1,1,3)
 # wi : (BatchSize,1,1,3) 
+# Any extra leading dimensions are broadcast between svbrdf, wi and wo (see tf_RenderBatched).
 def tf_Render(svbrdf, wi, wo, includeDiffuse = True):
+    #the lighting configurations follow the svbrdf dtype, see --precision. Python scalars go after the tensors in the binary ops
+    #so they take the svbrdf dtype instead of float32.
+    wi = as_input_dtype(wi, svbrdf)
+    wo = as_input_dtype(wo, svbrdf)
     wiNorm = tf_Normalize(wi)
     woNorm = tf_Normalize(wo)
     h = tf_Normalize(tf.add(wiNorm,woNorm) / 2.0)
-    diffuse = squeezeValues(deprocess(svbrdf[:,:,:,3:6]), 0.0,1.0)
-    normals = svbrdf[:,:,:,0:3]
-    specular = squeezeValues(deprocess(svbrdf[:,:,:,9:12]), 0.0, 1.0)
-    roughness = squeezeValues(deprocess(svbrdf[:,:,:,6:9]), 0.0, 1.0)
+    diffuse = squeezeValues(deprocess(svbrdf[...,3:6]), 0.0,1.0)
+    normals = svbrdf[...,0:3]
+    specular = squeezeValues(deprocess(svbrdf[...,9:12]), 0.0, 1.0)
+    roughness = squeezeValues(deprocess(svbrdf[...,6:9]), 0.0, 1.0)
     roughness = tf.maximum(roughness, 0.001)
     NdotH = tf_DotProduct(normals, h)
     NdotL = tf_DotProduct(normals, wiNorm)
@@ -991,9 +1724,9 @@ def tf_Render(svbrdf, wi, wo, includeDiffuse = True):
     VdotH = tf_DotProduct(woNorm, h)
 
     diffuse_rendered = tf_render_diffuse_Substance(diffuse, specular)
-    D_rendered = tf_render_D_GGX_Substance(roughness, tf.maximum(0.0, NdotH))
-    G_rendered = tf_render_G_GGX_Substance(roughness, tf.maximum(0.0, NdotL), tf.maximum(0.0, NdotV))
-    F_rendered = tf_render_F_GGX_Substance(specular, tf.maximum(0.0, VdotH))
+    D_rendered = tf_render_D_GGX_Substance(roughness, tf.maximum(NdotH, 0.0))
+    G_rendered = tf_render_G_GGX_Substance(roughness, tf.maximum(NdotL, 0.0), tf.maximum(NdotV, 0.0))
+    F_rendered = tf_render_F_GGX_Substance(specular, tf.maximum(VdotH, 0.0))
     
     
     specular_rendered = F_rendered * (G_rendered * D_rendered * 0.25)
@@ -1009,7 +1742,7 @@ def tf_Render(svbrdf, wi, wo, includeDiffuse = True):
     
     result = result * lampFactor
 
-    result = result * tf.maximum(0.0, NdotL) / tf.expand_dims(tf.maximum(wiNorm[:,:,:,2], 0.001), axis=-1) # This division is to compensate for the cosinus distribution of the intensity in the rendering
+    result = result * tf.maximum(NdotL, 0.0) / tf.expand_dims(tf.maximum(wiNorm[...,2], 0.001), axis=-1) # This division is to compensate for the cosinus distribution of the intensity in the rendering
 
     return [result, D_rendered, G_rendered, F_rendered, diffuse_rendered, diffuse]
     
@@ -7,12 +7,28 @@ tf.disable_v2_behavior()
 def conv(batch_input, out_channels, stride):
     with tf.variable_scope("conv"):
         in_channels = batch_input.get_shape()[3]
-        filter = tf.get_variable("filter", [4, 4, in_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
-        # [batch, in_height, in_width, in_channels], [filter_width, filter_height, in_channels, out_channels]
-        #     => [batch, out_height, out_width, out_channels]
-        padded_input = tf.pad(batch_input, [[0, 0], [1, 1], [1, 1], [0, 0]], mode="CONSTANT")
-        conv = tf.nn.conv2d(padded_input, filter, [1, stride, stride, 1], padding="VALID")
-        return conv
+        filter = conv_variables(in_channels, out_channels)
+        return conv_apply(batch_input, filter, stride)
+
+
+def conv_variables(in_channels, out_channels):
+    return tf.get_variable("filter", [4, 4, in_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+
+
+def conv_apply(batch_input, filter, stride):
+    # [batch, in_height, in_width, in_channels], [filter_width, filter_height, in_channels, out_channels]
+    #     => [batch, out_height, out_width, out_channels]
+    filter = as_input_dtype(filter, batch_input)
+    padded_input = tf.pad(batch_input, [[0, 0], [1, 1], [1, 1], [0, 0]], mode="CONSTANT")
+    conv = tf.nn.conv2d(padded_input, filter, [1, stride, stride, 1], padding="VALID")
+    return conv
+
+
+def as_input_dtype(tensor, input):
+    # the variables stay float32 (master weights), they are cast to the dtype of the activations they are applied to, see --precision.
+    if tensor.dtype.base_dtype == input.dtype.base_dtype:
+        return tensor
+    return tf.cast(tensor, input.dtype.base_dtype)
 
 
 def lrelu(x, a):
@@ -29,53 +45,105 @@ def lrelu(x, a):
 
 def instancenorm(input):
     with tf.variable_scope("instancenorm"):
+        offset, scale = instancenorm_variables(input.get_shape()[3])
+        return instancenorm_apply(input, offset, scale)
+
+
+def instancenorm_variables(channels):
+    offset = tf.get_variable("offset", [1, 1, 1, channels], dtype=tf.float32, initializer=tf.zeros_initializer())
+    scale = tf.get_variable("scale", [1, 1, 1, channels], dtype=tf.float32, initializer=tf.random_normal_initializer(1.0, 0.02))
+    return offset, scale
+
+
+def instancenorm_apply(input, offset, scale, statistics = None):
+    # statistics : (mean, variance) to normalize with instead of the ones of input, see tiled inference.
+    with tf.name_scope("instancenorm"):
         # this block looks like it has 3 inputs on the graph unless we do this
         input = tf.identity(input)
 
-        channels = input.get_shape()[3]
-        offset = tf.get_variable("offset", [1, 1, 1, channels], dtype=tf.float32, initializer=tf.zeros_initializer())
-        scale = tf.get_variable("scale", [1, 1, 1, channels], dtype=tf.float32, initializer=tf.random_normal_initializer(1.0, 0.02))
-        mean, variance = tf.nn.moments(input, axes=[1, 2], keep_dims=True)
+        #the statistics are always computed in float32, the global network reads them.
+        mean, variance = _moments(input, statistics)
         #[batchsize ,1,1, channelNb]
         variance_epsilon = 1e-5
         #Batch normalization function does the mean substraction then divide by the standard deviation (to normalize it). It finally multiply by scale and adds offset.
         #normalized = tf.nn.batch_normalization(input, mean, variance, offset, scale, variance_epsilon=variance_epsilon)
         #For instanceNorm we do it ourselves :
-        normalized = (((input - mean) / tf.sqrt(variance + variance_epsilon)) * scale) + offset
+        deviation = as_input_dtype(tf.sqrt(variance + variance_epsilon), input)
+        normalized = (((input - as_input_dtype(mean, input)) / deviation) * as_input_dtype(scale, input)) + as_input_dtype(offset, input)
         return normalized, mean, variance
 
 
+def instancenorm_fused_apply(input, offset, scale, bias = None, statistics = None):
+    # Same result as instancenorm_apply followed by + bias : the normalization, scale, offset and bias
+    # are folded into a per channel multiplier and shift so the feature map is only traversed once after the moments.
+    with tf.name_scope("instancenorm_fused"):
+        mean, variance = _moments(input, statistics)
+        variance_epsilon = 1e-5
+        multiplier = scale * tf.rsqrt(variance + variance_epsilon)
+        shift = offset - mean * multiplier
+        if bias is not None:
+            shift = shift + bias
+        return input * as_input_dtype(multiplier, input) + as_input_dtype(shift, input), mean, variance
+
+
+def _moments(input, statistics):
+    if statistics is not None:
+        return statistics
+    return tf.nn.moments(tf.cast(input, tf.float32), axes=[1, 2], keep_dims=True)
+
+
 def deconv(batch_input, out_channels):
    with tf.variable_scope("deconv"):
-        in_height, in_width, in_channels = [int(batch_input.get_shape()[1]), int(batch_input.get_shape()[2]), int(batch_input.get_shape()[3])]
-        #filter = tf.get_variable("filter", [4, 4, out_channels, in_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
-        filter = tf.get_variable("filter", [4, 4, in_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+        filter, filter1 = deconv_variables(int(batch_input.get_shape()[3]), out_channels)
+        return deconv_apply(batch_input, filter, filter1)
+
+
+def deconv_variables(in_channels, out_channels, subpixel = False):
+    if subpixel:
+        # the nearest upsample and the first conv rewritten at the input resolution, see deconv_subpixel_apply
+        filter = tf.get_variable("subpixel_filter", [3, 3, in_channels, 4 * out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
         filter1 = tf.get_variable("filter1", [4, 4, out_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+        return filter, filter1
+    #filter = tf.get_variable("filter", [4, 4, out_channels, in_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+    filter = tf.get_variable("filter", [4, 4, in_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+    filter1 = tf.get_variable("filter1", [4, 4, out_channels, out_channels], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.02))
+    return filter, filter1
 
-        # [batch, in_height, in_width, in_channels], [filter_width, filter_height, out_channels, in_channels]
-        #     => [batch, out_height, out_width, out_channels]
-        resized_images = tf.image.resize_images(batch_input, [in_height * 2, in_width * 2], method = tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-        conv = tf.nn.conv2d(resized_images, filter, [1, 1, 1, 1], padding="SAME")
-        conv = tf.nn.conv2d(conv, filter1, [1, 1, 1, 1], padding="SAME")
 
-        #conv = tf.nn.conv2d_transpose(batch_input, filter, [batch, in_height * 2, in_width * 2, out_channels], [1, 2, 2, 1], padding="SAME")
-        return conv
+def deconv_apply(batch_input, filter, filter1):
+    in_height, in_width = [int(batch_input.get_shape()[1]), int(batch_input.get_shape()[2])]
+    # [batch, in_height, in_width, in_channels], [filter_width, filter_height, out_channels, in_channels]
+    #     => [batch, out_height, out_width, out_channels]
+    resized_images = tf.image.resize_images(batch_input, [in_height * 2, in_width * 2], method = tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    conv = tf.nn.conv2d(resized_images, as_input_dtype(filter, batch_input), [1, 1, 1, 1], padding="SAME")
+    conv = tf.nn.conv2d(conv, as_input_dtype(filter1, batch_input), [1, 1, 1, 1], padding="SAME")
+
+    #conv = tf.nn.conv2d_transpose(batch_input, filter, [batch, in_height * 2, in_width * 2, out_channels], [1, 2, 2, 1], padding="SAME")
+    return conv
+
+
+def deconv_subpixel_apply(batch_input, subpixel_filter, filter1):
+    # Exactly deconv_apply when subpixel_filter is utils.subpixelExport.subpixel_kernel(filter) : after the nearest upsample every
+    # output pixel of the 4x4 conv only sees a 3x3 neighbourhood of the input, so the 4 output phases are computed at the input
+    # resolution as 4 * out_channels channels then interleaved by depth_to_space.
+    # [batch, in_height, in_width, in_channels] => [batch, in_height, in_width, 4 * out_channels] => [batch, in_height*2, in_width*2, out_channels]
+    conv = tf.nn.conv2d(batch_input, as_input_dtype(subpixel_filter, batch_input), [1, 1, 1, 1], padding="SAME")
+    conv = tf.nn.depth_to_space(conv, 2)
+    conv = tf.nn.conv2d(conv, as_input_dtype(filter1, batch_input), [1, 1, 1, 1], padding="SAME")
+    return conv
 
 
 def fullyConnected(input, outputDim, useBias, layerName = "layer", initMultiplyer = 1.0):
     with tf.variable_scope("fully_connected"):
-        batchSize = tf.shape(input)[0];
         inputChannels = int(input.get_shape()[-1])
         weights = tf.get_variable("weight", [inputChannels, outputDim ], dtype=tf.float32, initializer=tf.random_normal_initializer(0, initMultiplyer * tf.sqrt(1.0/float(inputChannels))))
-        weightsTiled = tf.tile(tf.expand_dims(weights, axis = 0), [batchSize, 1,1])
         squeezedInput = input
         
         if (len(input.get_shape()) > 3) :
             squeezedInput = tf.squeeze(squeezedInput, [1])
             squeezedInput = tf.squeeze(squeezedInput, [1])
-        #weightsTiled = tf.Print(weightsTiled,[tf.shape(weightsTiled)], "weightsTiled_dyn2 : ", summarize=10)          
-        outputs = tf.matmul(tf.expand_dims(squeezedInput, axis = 1), weightsTiled)
-        outputs = tf.squeeze(outputs, [1])
+        # [batch, inputChannels] x [inputChannels, outputDim], the weights are shared by the whole batch so there is no need to tile them.
+        outputs = tf.matmul(squeezedInput, weights)
         if(useBias):
             bias = tf.get_variable("bias", [outputDim], dtype=tf.float32, initializer=tf.random_normal_initializer(0, 0.002))
             outputs = outputs + tf.expand_dims(bias, axis = 0)
@@ -83,7 +151,86 @@ def fullyConnected(input, outputDim, useBias, layerName = "layer", initMultiplye
         return outputs
 
 
+def conv_block(batch_input, out_channels, stride, normalize = True, recompute = False, bias = None, fused = False, statistics = None):
+    # lrelu => conv (=> instancenorm + bias), returns (normalized, mean, variance) when normalize.
+    # With recompute only the block input and outputs are kept for the backward pass, the rest is recomputed.
+    # With fused the normalization and the bias are folded in a single multiply-add and lrelu is a single op.
+    # statistics replaces the instancenorm (mean, variance) of the block output, see instancenorm_apply.
+    with tf.variable_scope("conv"):
+        filter = conv_variables(batch_input.get_shape()[3], out_channels)
+
+    def convolve(batch_input, filter):
+        return conv_apply(_rectify(batch_input, fused), filter, stride)
+    return _norm_block(convolve, batch_input, [filter], out_channels, normalize, recompute, bias, fused, statistics)
+
+
+def deconv_block(batch_input, out_channels, normalize = True, recompute = False, bias = None, fused = False, subpixel = False, statistics = None):
+    # lrelu => deconv (=> instancenorm + bias), see conv_block.
+    # With subpixel the deconv runs from the rewritten weights of utils.subpixelExport.
+    with tf.variable_scope("deconv"):
+        filters = list(deconv_variables(int(batch_input.get_shape()[3]), out_channels, subpixel))
+
+    def deconvolve(batch_input, filter, filter1):
+        if subpixel:
+            return deconv_subpixel_apply(_rectify(batch_input, fused), filter, filter1)
+        return deconv_apply(_rectify(batch_input, fused), filter, filter1)
+    return _norm_block(deconvolve, batch_input, filters, out_channels, normalize, recompute, bias, fused, statistics)
+
+
+def _rectify(x, fused):
+    if fused:
+        return tf.nn.leaky_relu(x, alpha=0.2)
+    return lrelu(x, 0.2)
+
+
+def _norm_block(layer, batch_input, layer_variables, out_channels, normalize, recompute, bias, fused, statistics):
+    # the block inputs are batch_input, the layer variables, offset and scale then the optional bias and statistics.
+    norm_variables = []
+    if normalize:
+        with tf.variable_scope("instancenorm"):
+            norm_variables = list(instancenorm_variables(out_channels))
+        if bias is not None:
+            norm_variables.append(bias)
+        if statistics is not None:
+            norm_variables.extend(statistics)
+
+    def block(batch_input, *variables):
+        output = layer(batch_input, *variables[:len(layer_variables)])
+        if not normalize:
+            return output
+        offset, scale = variables[len(layer_variables):len(layer_variables) + 2]
+        optional = list(variables[len(layer_variables) + 2:])
+        block_bias = optional.pop(0) if bias is not None else None
+        block_statistics = tuple(optional) if statistics is not None else None
+        if fused:
+            return instancenorm_fused_apply(output, offset, scale, block_bias, block_statistics)
+        normalized, mean, variance = instancenorm_apply(output, offset, scale, block_statistics)
+        if block_bias is not None:
+            normalized = normalized + as_input_dtype(block_bias, normalized)
+        return normalized, mean, variance
+    if recompute:
+        block = recompute_grad(block)
+    return block(batch_input, *(layer_variables + norm_variables))
+
+
 def GlobalToGenerator(inputs, channels):
     with tf.variable_scope("GlobalToGenerator1"):
         fc1 = fullyConnected(inputs, channels, False, "fullyConnected_global_to_unet" ,0.01)
-    return tf.expand_dims(tf.expand_dims(fc1, axis = 1), axis=1)
\ No newline at end of file
+    return tf.expand_dims(tf.expand_dims(fc1, axis = 1), axis=1)
+
+def recompute_grad(fn):
+    # Wraps fn (a function of tensors without variables inside) so that its intermediate results are not kept for the backward pass :
+    # the gradient recomputes fn from its inputs. Tensors captured by fn instead of passed as inputs receive no gradient.
+    @tf.custom_gradient
+    def recomputed(*inputs):
+        outputs = fn(*inputs)
+        def grad(*output_grads):
+            # the control dependency makes sure the recomputation only happens during the backward pass
+            with tf.control_dependencies(list(output_grads)):
+                recompute_inputs = [tf.identity(x) for x in inputs]
+            recompute_outputs = fn(*recompute_inputs)
+            if not isinstance(recompute_outputs, (list, tuple)):
+                recompute_outputs = [recompute_outputs]
+            return tf.gradients(list(recompute_outputs), recompute_inputs, grad_ys=list(output_grads))
+        return outputs, grad
+    return recomputed
@@ -1,16 +0,0 @@
-class inputMaterial:
-    def __init__(self, name, lightPower, lightXPos, lightYPos, lightZPos, camXPos, camYPos, camZPos, uvscale, uoffset, voffset, rotation, identifier, path):
-        self.substanceName = name
-        self.lightPower = lightPower
-        self.lightXPos = lightXPos
-        self.lightYPos = lightYPos
-        self.lightZPos = lightZPos
-        self.camXPos = camXPos
-        self.camYPos = camYPos
-        self.camZPos = camZPos
-        self.uvscale = uvscale
-        self.uoffset = uoffset
-        self.voffset = voffset
-        self.rotation = rotation
-        self.identifier = identifier
-        self.path = path
\ No newline at end of file
@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import numpy as np
+
+# Synchronous data parallel training of material_net.py --mode train --workers N : every worker runs its own session on its shard of the
+# training set, the gradients and losses of each step are summed over a TCP ring between the workers and applied by all of them.
+# The workers only need plain sockets between each other, on one host (loopback) or several ones.
+
+# (host, port) of every worker in rank order, consecutive loopback ports from basePort when workerHosts (comma separated host:port) is None.
+def worker_addresses(workers, workerHosts, basePort):
+    if workerHosts is None:
+        return [("127.0.0.1", basePort + rank) for rank in range(workers)]
+    addresses = []
+    for hostPort in workerHosts.split(","):
+        host, port = hostPort.strip().rsplit(":", 1)
+        addresses.append((host, int(port)))
+    if len(addresses) != workers:
+        raise Exception("--workerHosts lists %d workers instead of %d" % (len(addresses), workers))
+    return addresses
+
+# Starts the local workers of rank 1 to workers - 1 with the command line of rank 0, each one writing its logs in its own directory.
+def spawn_local_workers(workers, outputDir, seed):
+    processes = []
+    for rank in range(1, workers):
+        workerDir = os.path.join(outputDir, "worker%d" % rank)
+        command = [sys.executable] + sys.argv + ["--workerRank", str(rank), "--output_dir", workerDir, "--seed", str(seed)]
+        processes.append(subprocess.Popen(command))
+    return processes
+
+def _connect(address, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except OSError:
+            # the next worker may not be listening yet.
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def _receive_into(connection, buffer):
+    view = memoryview(buffer).cast("B")
+    received = 0
+    while received < len(view):
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            raise Exception("a training worker closed its connection")
+        received += count
+
+# Each worker listens on its address, sends to the next worker of the ring and receives from the previous one.
+class RingAllReduce:
+    def __init__(self, rank, addresses, connectTimeout = 600.0):
+        self.rank = rank
+        self.size = len(addresses)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("", addresses[rank][1]))
+        listener.listen(1)
+        self.next = _connect(addresses[(rank + 1) % self.size], connectTimeout)
+        self.previous, _ = listener.accept()
+        listener.close()
+        for connection in [self.next, self.previous]:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Sends send to the next worker while receiving the same number of values from the previous one into receive.
+    def _exchange(self, send, receive):
+        errors = []
+        def send_all():
+            try:
+                self.next.sendall(memoryview(send).cast("B"))
+            except Exception as error:
+                errors.append(error)
+        sender = threading.Thread(target=send_all)
+        sender.start()
+        _receive_into(self.previous, receive)
+        sender.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    # Sum of the float32 vector values over all the workers : a reduce-scatter then an all-gather of size chunks,
+    # each worker sends and receives 2 * (size - 1) / size times the vector.
+    def allreduce(self, values):
+        values = np.array(values, dtype=np.float32).ravel()
+        if self.size == 1:
+            return values
+        bounds = np.linspace(0, len(values), self.size + 1).astype(np.int64)
+        chunks = [values[bounds[i]:bounds[i + 1]] for i in range(self.size)]
+        receive = np.empty(max(len(chunk) for chunk in chunks), dtype=np.float32)
+        for step in range(self.size - 1):
+            sendId = (self.rank - step) % self.size
+            receiveId = (self.rank - step - 1) % self.size
+            received = receive[:len(chunks[receiveId])]
+            self._exchange(np.ascontiguousarray(chunks[sendId]), received)
+            chunks[receiveId] += received
+        for step in range(self.size - 1):
+            sendId = (self.rank - step + 1) % self.size
+            receiveId = (self.rank - step) % self.size
+            received = receive[:len(chunks[receiveId])]
+            self._exchange(np.ascontiguousarray(chunks[sendId]), received)
+            chunks[receiveId][:] = received
+        return values
+
+    # The values of worker root on every worker.
+    def broadcast(self, values, root = 0):
+        values = np.array(values, dtype=np.float32).ravel()
+        if self.rank != root:
+            values = np.zeros_like(values)
+        return self.allreduce(values)
+
+    def close(self):
+        self.next.close()
+        self.previous.close()
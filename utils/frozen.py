@@ -0,0 +1,67 @@
+# Loads the inference graph written by material_net.py --mode export and runs it without rebuilding the network or restoring a checkpoint.
+# Run from the repository root : python -m utils.frozen --export_dir exported --output_dir outputs picture1.png picture2.png
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import tensorflow._api.v2.compat.v1 as tf
+tf.disable_v2_behavior()
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+FROZEN_GRAPH = "frozen_model.pb"
+EXPORT_MANIFEST = "export.json"
+EXPORT_INPUT = "image"
+EXPORT_OUTPUTS = ["normals", "diffuse", "roughness", "specular"]
+
+class FrozenMaterialNet:
+    def __init__(self, exportDir, config = None):
+        with open(os.path.join(exportDir, EXPORT_MANIFEST)) as f:
+            self.manifest = json.loads(f.read())
+        graphDef = tf.GraphDef()
+        with open(os.path.join(exportDir, self.manifest["graph"]), "rb") as f:
+            graphDef.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graphDef, name="")
+        self.input = self.graph.get_tensor_by_name(self.manifest["input"] + ":0")
+        self.outputs = {name: self.graph.get_tensor_by_name(name + ":0") for name in self.manifest["outputs"]}
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    # images : [batch, height, width, 3] or [height, width, 3] linear pictures in [0, 1] (or gamma corrected ones if exported with --correctGamma).
+    # Returns the maps in [0, 1] by name, [batch, scale_size, scale_size, 3] each.
+    def run(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        return self.session.run(self.outputs, feed_dict={self.input: images})
+
+    def close(self):
+        self.session.close()
+
+def main():
+    import imageio
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export_dir", required=True, help="directory written by material_net.py --mode export")
+    parser.add_argument("--output_dir", required=True, help="where to put the maps")
+    parser.add_argument("pictures", nargs="+", help="pictures to evaluate")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    net = FrozenMaterialNet(args.export_dir)
+    for picturePath in args.pictures:
+        picture = imageio.imread(picturePath)[..., :3]
+        maps = net.run(picture.astype(np.float32) / np.iinfo(picture.dtype).max)
+        name, _ = os.path.splitext(os.path.basename(picturePath))
+        for mapName in EXPORT_OUTPUTS:
+            imageio.imwrite(os.path.join(args.output_dir, name + "-" + mapName + ".png"), np.round(np.clip(maps[mapName][0], 0.0, 1.0) * 255.0).astype(np.uint8))
+        print("evaluated image", name)
+    net.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import math
+import numpy as np
+
+LIGHT_BANK_FILE = "lightBank.npz"
+
+# A fixed set of rendering configurations for the rendering loss, drawn with the same distributions as
+# tf_generate_normalized_random_direction and tf_generate_distance in material_net.py.
+# diffuseLights, diffuseViews : [size, 3] directions of the diffuse renderings.
+# specularLights, specularViews : [size, 3] positions of the specular renderings.
+
+def _random_directions(random, size, lowEps = 0.001, highEps = 0.05):
+    r = np.sqrt(random.uniform(0.0 + lowEps, 1.0 - highEps, size))
+    phi = 2 * math.pi * random.uniform(0.0, 1.0, size)
+    return np.stack([r * np.cos(phi), r * np.sin(phi), np.sqrt(1.0 - np.square(r))], axis = -1)
+
+def _random_distances(random, size):
+    return np.exp(random.normal(0.5, 0.75, [size, 1]))
+
+def generate_light_bank(size, seed):
+    random = np.random.RandomState(seed)
+    diffuseLights = _random_directions(random, size)
+    diffuseViews = _random_directions(random, size)
+    viewDirections = _random_directions(random, size)
+    lightDirections = viewDirections * np.array([[-1.0, -1.0, 1.0]])
+    #Shift position to have highlight elsewhere than in the center.
+    shift = np.concatenate([random.uniform(-1.0, 1.0, [size, 2]), np.zeros([size, 1]) + 0.0001], axis = -1)
+    specularViews = viewDirections * _random_distances(random, size) + shift
+    specularLights = lightDirections * _random_distances(random, size) + shift
+    return {
+        "diffuseLights": diffuseLights.astype(np.float32),
+        "diffuseViews": diffuseViews.astype(np.float32),
+        "specularLights": specularLights.astype(np.float32),
+        "specularViews": specularViews.astype(np.float32),
+    }
+
+def save_light_bank(bank, directory):
+    np.savez(os.path.join(directory, LIGHT_BANK_FILE), **bank)
+
+def load_light_bank(directory):
+    with np.load(os.path.join(directory, LIGHT_BANK_FILE), allow_pickle=False) as stored:
+        return {key : stored[key] for key in stored.files}
+
+# Reuses the bank of the checkpoint we resume from if it has one, so the cached renderings stay meaningful.
+def load_or_create_light_bank(size, seed, outputDir, checkpointDir = None):
+    if checkpointDir is not None and os.path.exists(os.path.join(checkpointDir, LIGHT_BANK_FILE)):
+        bank = load_light_bank(checkpointDir)
+        print("loaded light bank of size %d from %s" % (len(bank["diffuseLights"]), checkpointDir))
+    else:
+        bank = generate_light_bank(size, seed)
+    save_light_bank(bank, outputDir)
+    return bank
@@ -0,0 +1,122 @@
+import os
+import collections
+import numpy as np
+from lxml import etree
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.npz"
+
+# Columnar view of an input XML. A group is one (substance, variation) pair, items are the images.
+# substanceNames : [nbSubstances] sorted substance names, so substance ids follow the sorted order.
+# groupSubstances : [nbGroups] substance id of each group, groups are numbered in XML order of first appearance.
+# groupKeys : [nbGroups] variation key of each group.
+# itemGroups : [nbItems] group id of each image, in XML order.
+# paths : [nbItems] image paths, in XML order.
+MaterialIndex = collections.namedtuple("MaterialIndex", "substanceNames, groupSubstances, groupKeys, itemGroups, paths")
+
+def _xml_key(xmlPath):
+    stat = os.stat(xmlPath)
+    return np.array([stat.st_mtime_ns, stat.st_size, INDEX_VERSION], dtype=np.int64)
+
+def parse_material_xml(xmlPath):
+    groupIds = {}
+    groupSubstanceNames = []
+    groupKeys = []
+    itemGroups = []
+    paths = []
+    for event, elem in etree.iterparse(xmlPath, tag="item"):
+        imagePath = elem.find('image').text
+        if not (imagePath is None) and os.path.exists(imagePath):
+            identifier = elem.find('identifier').text
+            substanceName = imagePath.split("/")[-1]
+            if(substanceName.split('.')[0].isdigit()):
+                substanceName = '%04d' % int(substanceName.split('.')[0])
+            substanceNumber = 0
+            imageSplitsemi = imagePath.split(";")
+            if len(imageSplitsemi) > 1:                    
+                substanceName = imageSplitsemi[1]
+                substanceNumber = imageSplitsemi[2].split(".")[0]
+            idkey = str(substanceNumber) +";"+ identifier.rsplit(";", 1)[0]
+
+            groupId = groupIds.get((substanceName, idkey))
+            if groupId is None:
+                groupId = len(groupKeys)
+                groupIds[(substanceName, idkey)] = groupId
+                groupSubstanceNames.append(substanceName)
+                groupKeys.append(idkey)
+            itemGroups.append(groupId)
+            paths.append(imagePath)
+        #Free the parsed element, we only keep the columns.
+        elem.clear()
+
+    substanceNames = sorted(set(groupSubstanceNames))
+    substanceIds = {name : substanceId for substanceId, name in enumerate(substanceNames)}
+    return MaterialIndex(
+        substanceNames = np.array(substanceNames, dtype=np.str_),
+        groupSubstances = np.array([substanceIds[name] for name in groupSubstanceNames], dtype=np.int32),
+        groupKeys = np.array(groupKeys, dtype=np.str_),
+        itemGroups = np.array(itemGroups, dtype=np.int32),
+        paths = np.array(paths, dtype=np.str_),
+    )
+
+def save_material_index(index, indexPath, key):
+    tmpPath = indexPath + ".tmp.npz"
+    np.savez(tmpPath, key = key, **index._asdict())
+    os.replace(tmpPath, indexPath)
+
+def load_material_index(xmlPath):
+    key = _xml_key(xmlPath)
+    indexPath = xmlPath + INDEX_SUFFIX
+    if os.path.exists(indexPath):
+        with np.load(indexPath, allow_pickle=False) as stored:
+            if np.array_equal(stored["key"], key):
+                return MaterialIndex(**{field : stored[field] for field in MaterialIndex._fields})
+        print("xml changed since " + indexPath + " was written, rebuilding it")
+    index = parse_material_xml(xmlPath)
+    try:
+        save_material_index(index, indexPath, key)
+    except OSError as e:
+        print("could not write the xml index : " + str(e))
+    return index
+
+# Returns the groups ordered by substance name then by first appearance, and for each of them the item ids in XML order.
+def sorted_groups(index):
+    groupOrder = np.lexsort((np.arange(len(index.groupSubstances)), index.groupSubstances))
+    itemOrder = np.argsort(index.itemGroups, kind="stable")
+    groupSizes = np.bincount(index.itemGroups, minlength=len(index.groupSubstances))
+    groupEnds = np.cumsum(groupSizes)
+    groupStarts = groupEnds - groupSizes
+    return groupOrder, itemOrder, groupStarts, groupEnds
+
+# Draws the paths of one epoch lazily from the index, to be used as a tf.data generator.
+# Each call is a new epoch: every group yields all its images if allVariations, otherwise two random images (or its only one).
+# With resample, every epoch draws new pairs and a new group order, otherwise all epochs repeat the draw of the first one.
+# With nbShards, only the groups shardId, shardId + nbShards, ... of the sorted order are drawn, so the shards have no material in common.
+class MaterialSampler:
+    def __init__(self, index, allVariations, shuffleGroups, resample, seed, shardId = 0, nbShards = 1):
+        self.paths = index.paths
+        self.groupOrder, self.itemOrder, self.groupStarts, self.groupEnds = sorted_groups(index)
+        self.groupOrder = self.groupOrder[shardId::nbShards]
+        self.allVariations = allVariations
+        self.shuffleGroups = shuffleGroups
+        self.resample = resample
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        groupSizes = (self.groupEnds - self.groupStarts)[self.groupOrder]
+        self.count = int(np.sum(groupSizes if allVariations else np.minimum(groupSizes, 2)))
+
+    def __len__(self):
+        return self.count
+
+    def __call__(self):
+        if not self.resample:
+            self.random = np.random.RandomState(self.seed)
+        groupOrder = self.groupOrder
+        if self.shuffleGroups:
+            groupOrder = self.random.permutation(groupOrder)
+        for groupId in groupOrder:
+            items = self.itemOrder[self.groupStarts[groupId]:self.groupEnds[groupId]]
+            if not self.allVariations and len(items) > 1:
+                items = self.random.choice(items, 2, replace = False)
+            for item in items:
+                yield self.paths[item]
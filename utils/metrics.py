@@ -0,0 +1,76 @@
+import os
+import csv
+import json
+import numpy as np
+
+from utils.lightBank import generate_light_bank
+
+# Test metrics of material_net.py --mode test --metrics. They are computed per image in the graph (see tf_test_metrics),
+# this module only streams them to METRICS_FILE and keeps running statistics, so no image is ever held in memory.
+# rendering : L1 of the log renderings under the fixed evaluation light set, as in the rendering loss.
+# normal_angle : mean angle in degrees between the predicted and true normals.
+# diffuse_log_l1, specular_log_l1 : L1 of the log albedos, as in the l1 loss.
+# roughness_l1 : L1 of the roughness in [0, 1].
+METRIC_NAMES = ["rendering", "normal_angle", "diffuse_log_l1", "specular_log_l1", "roughness_l1"]
+METRICS_FILE = "metrics.csv"
+METRICS_SUMMARY = "metrics.json"
+# The evaluation light set is drawn from a fixed seed, so every checkpoint is scored under the same renderings.
+METRIC_LIGHTS_SEED = 20180801
+
+def metric_light_set(size):
+    return generate_light_bank(size, METRIC_LIGHTS_SEED)
+
+# Count, mean, variance (Welford / Chan et al. merge of the batch statistics), min and max of a stream of values.
+class RunningStatistics:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        batchMean = values.mean()
+        batchM2 = np.square(values - batchMean).sum()
+        count = self.count + len(values)
+        delta = batchMean - self.mean
+        self.mean += delta * len(values) / count
+        self.m2 += batchM2 + delta * delta * self.count * len(values) / count
+        self.count = count
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "mean": float(self.mean), "std": float(np.sqrt(self.m2 / self.count)), "min": float(self.min), "max": float(self.max)}
+
+# Writes one row per image to METRICS_FILE as the batches come and METRICS_SUMMARY when closed.
+class MetricsWriter:
+    def __init__(self, outputDir, names = METRIC_NAMES, details = None):
+        self.outputDir = outputDir
+        self.names = names
+        self.details = details if details is not None else {}
+        self.statistics = {name: RunningStatistics() for name in names}
+        self.file = open(os.path.join(outputDir, METRICS_FILE), "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["name"] + names)
+
+    # paths : [batch] fetched paths, metrics : {name: [batch] values}.
+    def add(self, paths, metrics):
+        for i, path in enumerate(paths):
+            name = os.path.splitext(os.path.basename(path.decode("utf8")))[0]
+            self.writer.writerow([name] + ["%.6g" % metrics[metricName][i] for metricName in self.names])
+        for metricName in self.names:
+            self.statistics[metricName].add(metrics[metricName])
+
+    def close(self):
+        self.file.close()
+        summary = dict(self.details)
+        summary["metrics"] = {name: self.statistics[name].summary() for name in self.names}
+        with open(os.path.join(self.outputDir, METRICS_SUMMARY), "w") as f:
+            f.write(json.dumps(summary, sort_keys=True, indent=4))
+        return summary
@@ -0,0 +1,99 @@
+import os
+import json
+import numpy as np
+
+# Writers of the predicted maps for --outputFormat other than png. They receive the fetched linear maps in [0, 1],
+# [batch, height, width, 12] arrays with the normals, diffuse, roughness and specular maps as consecutive RGB triplets.
+MAP_NAMES = ["normals", "diffuse", "roughness", "specular"]
+MAPS_FILE = "maps.npy"
+MAPS_MANIFEST = "maps.json"
+
+def _names(paths):
+    return [os.path.splitext(os.path.basename(path.decode("utf8")))[0] for path in paths]
+
+# One name-maps.npy [height, width, 12] file per picture, written straight from the fetched array.
+class NpyMapWriter:
+    def __init__(self, outputDir):
+        self.mapDir = os.path.join(outputDir, "maps")
+        if not os.path.exists(self.mapDir):
+            os.makedirs(self.mapDir)
+
+    def write(self, paths, maps):
+        names = _names(paths)
+        for name, pictureMaps in zip(names, maps):
+            np.save(os.path.join(self.mapDir, name + "-maps.npy"), pictureMaps)
+        return names
+
+    def close(self):
+        pass
+
+# A single maps.npy [count, height, width, 12] memory mapped array for the whole run, filled in evaluation order.
+# maps.json lists the picture of each row and the map channels.
+class MemmapMapWriter:
+    def __init__(self, outputDir, count, size, dtype):
+        self.outputDir = outputDir
+        self.maps = np.lib.format.open_memmap(os.path.join(outputDir, MAPS_FILE), mode="w+", dtype=dtype, shape=(count, size, size, 3 * len(MAP_NAMES)))
+        self.names = []
+
+    def write(self, paths, maps):
+        names = _names(paths)
+        self.maps[len(self.names):len(self.names) + len(names)] = maps
+        self.names.extend(names)
+        return names
+
+    def close(self):
+        self.maps.flush()
+        manifest = {"file": MAPS_FILE, "shape": list(self.maps.shape), "dtype": str(self.maps.dtype), "maps": MAP_NAMES, "names": self.names}
+        with open(os.path.join(self.outputDir, MAPS_MANIFEST), "w") as f:
+            f.write(json.dumps(manifest, indent=4))
+        del self.maps
+
+# One name-map.exr file per picture and map, needs the OpenEXR module.
+class ExrMapWriter:
+    def __init__(self, outputDir, dtype):
+        try:
+            import OpenEXR
+            import Imath
+        except ImportError:
+            raise Exception("--outputFormat exr needs the OpenEXR python module")
+        self.OpenEXR = OpenEXR
+        self.dtype = np.dtype(dtype)
+        self.pixelType = Imath.PixelType(Imath.PixelType.HALF if self.dtype == np.float16 else Imath.PixelType.FLOAT)
+        self.channel = Imath.Channel(self.pixelType)
+        self.mapDir = os.path.join(outputDir, "maps")
+        if not os.path.exists(self.mapDir):
+            os.makedirs(self.mapDir)
+
+    def write(self, paths, maps):
+        names = _names(paths)
+        for name, pictureMaps in zip(names, maps):
+            height, width = pictureMaps.shape[:2]
+            for mapId, mapName in enumerate(MAP_NAMES):
+                header = self.OpenEXR.Header(width, height)
+                header["channels"] = {channel: self.channel for channel in "RGB"}
+                exr = self.OpenEXR.OutputFile(os.path.join(self.mapDir, name + "-" + mapName + ".exr"), header)
+                exr.writePixels({channel: np.ascontiguousarray(pictureMaps[..., 3 * mapId + channelId], dtype=self.dtype).tobytes() for channelId, channel in enumerate("RGB")})
+                exr.close()
+        return names
+
+    def close(self):
+        pass
+
+# Evaluates without writing anything, to measure the model alone.
+class NoMapWriter:
+    def write(self, paths, maps):
+        return _names(paths)
+
+    def close(self):
+        pass
+
+def create_map_writer(outputFormat, outputDir, count, size, dtype):
+    if outputFormat == "npy":
+        return NpyMapWriter(outputDir)
+    elif outputFormat == "memmap":
+        return MemmapMapWriter(outputDir, count, size, dtype)
+    elif outputFormat == "exr":
+        return ExrMapWriter(outputDir, dtype)
+    elif outputFormat == "none":
+        return NoMapWriter()
+    raise Exception("no map writer for output format " + outputFormat)
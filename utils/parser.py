@@ -3,7 +3,7 @@ import argparse
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_dir", help="path to xml file, folder or image (defined by --imageFormat) containing information images")
-    parser.add_argument("--mode", required=True, choices=["test", "train", "eval"])
+    parser.add_argument("--mode", required=True, choices=["test", "train", "eval", "cache", "export", "serve", "watch"])
     parser.add_argument("--output_dir", required=True, help="where to put output files")
     parser.add_argument("--seed", type=int)
     parser.add_argument("--checkpoint", default=None, help="directory with checkpoint to resume training from or use for testing")
@@ -19,6 +19,15 @@ def parse_arguments():
 
     parser.add_argument("--testMode", type=str, default="auto", choices=["auto", "xml", "folder", "image"], help="Which loss to use instead of the L1 loss")
     parser.add_argument("--imageFormat", type=str, default="png", choices=["jpg", "png", "jpeg", "JPG", "JPEG", "PNG"], help="Which format have the input files")
+    parser.add_argument("--inputPipeline", type=str, default="serial", choices=["serial", "parallel"], help="serial decodes one image at a time, parallel interleaves file reads, decodes on several threads and prefetches batches")
+    parser.add_argument("--inputThreads", type=int, default=0, help="Number of parallel decode calls in the parallel input pipeline, 0 to autotune")
+    parser.add_argument("--readCycle", type=int, default=4, help="Number of files read concurrently in the parallel input pipeline")
+    parser.add_argument("--cacheDir", default=None, help="Directory of pre-decoded training shards, written by --mode cache and streamed by --mode train instead of decoding the input_dir images")
+    parser.add_argument("--shardSize", type=int, default=1024, help="Number of examples per shard written by --mode cache")
+    parser.add_argument("--cacheShuffleBuffer", type=int, default=512, help="Number of examples shuffled together when training from --cacheDir")
+    parser.add_argument("--cropsPerDecode", type=int, default=1, help="Number of training crops taken at independent random offsets from each decoded image, 1 takes a single crop shared by the batch")
+    parser.add_argument("--cropShuffleBuffer", type=int, default=64, help="Number of crops shuffled together when --cropsPerDecode is larger than 1")
+    parser.add_argument("--prefetchBatches", type=int, default=2, help="Number of batches prefetched in the parallel input pipeline, 0 to autotune")
 
     parser.add_argument("--aspect_ratio", type=float, default=1.0, help="aspect ratio of output images (width/height)")
     parser.add_argument("--batch_size", type=int, default=1, help="number of images in batch")
@@ -40,6 +49,45 @@ def parse_arguments():
 
     parser.add_argument("--nbDiffuseRendering", type=int, default=3, help="Number of diffuse renderings in the rendering loss")
     parser.add_argument("--nbSpecularRendering", type=int, default=6, help="Number of specular renderings in the rendering loss")
+    parser.add_argument("--renderImplementation", type=str, default="loop", choices=["loop", "batched", "chunked"], help="loop builds one render subgraph per rendering, batched renders targets and outputs under all the lightings in one pass per rendering type, chunked accumulates the loss over chunks of renderings and recomputes them in the backward pass to bound memory")
+    parser.add_argument("--renderChunkSize", type=int, default=1, help="Number of renderings per chunk with --renderImplementation chunked")
+    parser.add_argument("--lightBankSize", type=int, default=0, help="Size of a fixed bank of diffuse and of specular lighting configurations for the rendering loss. The ground truth is rendered in the input pipeline, the training step only renders the outputs. 0 draws new random lightings every step")
+    parser.add_argument("--lightBankCache", default=None, help="Render the ground truth under the whole light bank once and cache it : a file prefix to cache on disk or an empty string to cache in memory. Needs scale_size 256. The first epoch's examples and order are then repeated, so it cannot be used with an xml input_dir or --cacheDir, and the cache holds 2 * lightBankSize 256x256 renderings per example")
+    parser.add_argument("--recomputeActivations", dest="recomputeActivations", action="store_true", help="Only keep the generator block boundaries for the backward pass and recompute the conv, deconv and instancenorm internals")
+    parser.set_defaults(recomputeActivations=False)
+    parser.add_argument("--fusedNorm", dest="fusedNorm", action="store_true", help="Fold the generator instancenorm, scale, offset and global bias into one multiply-add and use a single leaky relu op, for training and inference")
+    parser.set_defaults(fusedNorm=False)
+    parser.add_argument("--subpixelDecoder", dest="subpixelDecoder", action="store_true", help="Run the decoder upsample convolutions at the input resolution from weights rewritten by utils.subpixelExport (inference only, loaded from the checkpoint options)")
+    parser.set_defaults(subpixelDecoder=False)
+    parser.add_argument("--precision", type=str, default="float32", choices=["float32", "bfloat16"], help="dtype of the generator convolutions and of the renderings of the rendering loss. Weights, normalization statistics, the global network, log terms and losses stay float32. See --precisionReport")
+    parser.add_argument("--precisionReport", dest="precisionReport", action="store_true", help="In test mode with a reduced --precision, also run the float32 network on the same weights and write the difference of the maps to precision.json")
+    parser.set_defaults(precisionReport=False)
+    parser.add_argument("--tileSize", type=int, default=0, help="Eval pictures at their full resolution on overlapping tiles of this size (a multiple of 256), with the global features of the whole picture downsampled. 0 downsamples the pictures to 256")
+    parser.add_argument("--tileOverlap", type=int, default=64, help="Overlap in pixels between neighbouring tiles, blended linearly")
+    parser.add_argument("--tileBatch", type=int, default=4, help="Number of tiles run together, bounds the memory of tiled eval")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address the serve mode listens on")
+    parser.add_argument("--port", type=int, default=8000, help="Port the serve mode listens on")
+    parser.add_argument("--serveBatch", type=int, default=8, help="Maximum number of requests run together by the serve mode")
+    parser.add_argument("--serveLatency", type=float, default=10.0, help="Milliseconds the serve mode waits after a request for others to batch with it")
+    parser.add_argument("--outputFormat", type=str, default="png", choices=["png", "npy", "memmap", "exr", "none"], help="How test and eval write the predicted maps : 8 bit png with an index.html, linear maps in a npy file per picture, a single memory mapped maps.npy for the run, exr files (needs OpenEXR) or nothing")
+    parser.add_argument("--outputDtype", type=str, default="float32", choices=["float32", "float16"], help="Precision of the npy, memmap and exr outputs")
+    parser.add_argument("--writerQueue", type=int, default=4, help="Number of fetched batches the background writer can hold while their images are written, 0 writes them synchronously")
+    parser.add_argument("--reportPageSize", type=int, default=100, help="Number of pictures per page of the html report, the pages are linked from index.html")
+    parser.add_argument("--metrics", dest="metrics", action="store_true", help="In test mode, write the rendering and per map errors of every image to metrics.csv and their statistics to metrics.json, use --outputFormat none to skip the images")
+    parser.set_defaults(metrics=False)
+    parser.add_argument("--metricLights", type=int, default=8, help="Number of diffuse and of specular configurations of the fixed light set of the rendering metric")
+    parser.add_argument("--backgroundTest", dest="backgroundTest", action="store_true", help="Evaluate the training checkpoints in a separate low priority process (--mode watch) instead of pausing the training every test_freq steps")
+    parser.set_defaults(backgroundTest=False)
+    parser.add_argument("--evalThreads", type=int, default=2, help="Number of intra and inter op threads of the background evaluator")
+    parser.add_argument("--evalNice", type=int, default=10, help="Niceness added to the background evaluator process")
+    parser.add_argument("--watchInterval", type=float, default=30.0, help="Seconds between two checks for a new checkpoint in watch mode")
+    parser.add_argument("--accumulateSteps", type=int, default=1, help="Number of batches whose gradients are averaged into each Adam update, a training step then trains on accumulateSteps * batch_size examples")
+    parser.add_argument("--workers", type=int, default=1, help="Number of synchronous data parallel training processes, their gradients are averaged over TCP every step")
+    parser.add_argument("--workerRank", type=int, default=0, help="Rank of this training process among --workers, the first one writes the checkpoints and starts the other local ones when --workerHosts is not given")
+    parser.add_argument("--workerHosts", default=None, help="Comma separated host:port of every worker in rank order, to train on several hosts. Each worker is started by hand with its --workerRank")
+    parser.add_argument("--workerPort", type=int, default=29500, help="First port of the local workers, they listen on consecutive ports of 127.0.0.1")
+    parser.add_argument("--profileMemory", dest="profileMemory", action="store_true", help="Trace the training step every progress_freq steps and print its peak memory")
+    parser.set_defaults(profileMemory=False)
     parser.add_argument("--lr", type=float, default=0.00002, help="initial learning rate for adam")
     parser.add_argument("--beta1", type=float, default=0.5, help="momentum term of adam")
     parser.add_argument("--includeDiffuse", dest="includeDiffuse", action="store_true", help="Include the diffuse term in the specular renderings of the rendering loss ?")
@@ -0,0 +1,20 @@
+import resource
+
+# Peak bytes in use per allocator during a sess.run traced with tf.RunOptions.FULL_TRACE.
+def peak_allocator_bytes(run_metadata):
+    peaks = {}
+    for devStats in run_metadata.step_stats.dev_stats:
+        for nodeStats in devStats.node_stats:
+            for memory in nodeStats.memory:
+                peak = max(memory.peak_bytes, memory.allocator_bytes_in_use)
+                peaks[memory.allocator_name] = max(peaks.get(memory.allocator_name, 0), peak)
+    return peaks
+
+# Maximum resident set size of this process so far (ru_maxrss is in kilobytes on linux).
+def max_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def print_peak_memory(run_metadata, label):
+    for allocator, peak in sorted(peak_allocator_bytes(run_metadata).items()):
+        print("peak memory %s  %s %0.1f MB" % (label, allocator, peak / 2.0**20))
+    print("peak memory %s  max rss %0.1f MB" % (label, max_rss_bytes() / 2.0**20))
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import tensorflow._api.v2.compat.v1 as tf
+tf.disable_v2_behavior()
+
+import os
+import json
+
+CACHE_MANIFEST = "cache.json"
+
+#Writes pre-decoded examples as raw uint8 panels [nbTargets + 1, scaleSize, scaleSize, 3] into TFRecord shards of shardSize examples.
+class ShardWriter:
+    def __init__(self, cacheDir, shardSize, scaleSize, nbTargets):
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        self.cacheDir = cacheDir
+        self.shardSize = shardSize
+        self.scaleSize = scaleSize
+        self.nbTargets = nbTargets
+        self.shards = []
+        self.count = 0
+        self.writer = None
+
+    def write(self, path, panels):
+        if self.count % self.shardSize == 0:
+            self._open_next_shard()
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "path": tf.train.Feature(bytes_list=tf.train.BytesList(value=[path])),
+            "panels": tf.train.Feature(bytes_list=tf.train.BytesList(value=[panels])),
+        }))
+        self.writer.write(example.SerializeToString())
+        self.count += 1
+
+    def _open_next_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+        shardName = "shard-%05d.tfrecord" % len(self.shards)
+        self.shards.append(shardName)
+        self.writer = tf.python_io.TFRecordWriter(os.path.join(self.cacheDir, shardName))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        manifest = {"count": self.count, "scale_size": self.scaleSize, "nbTargets": self.nbTargets, "shards": self.shards}
+        with open(os.path.join(self.cacheDir, CACHE_MANIFEST), "w") as f:
+            f.write(json.dumps(manifest, sort_keys=True, indent=4))
+        return manifest
+
+
+def read_cache_manifest(cacheDir):
+    manifestPath = os.path.join(cacheDir, CACHE_MANIFEST)
+    if not os.path.exists(manifestPath):
+        raise Exception("no cache manifest found in " + cacheDir + ", run --mode cache first")
+    with open(manifestPath) as f:
+        manifest = json.loads(f.read())
+    manifest["shards"] = [os.path.join(cacheDir, shard) for shard in manifest["shards"]]
+    return manifest
+
+
+def parse_cached_example(serialized, nbTargets, scaleSize):
+    features = tf.parse_single_example(serialized, {
+        "path": tf.FixedLenFeature([], tf.string),
+        "panels": tf.FixedLenFeature([], tf.string),
+    })
+    panels = tf.decode_raw(features["panels"], tf.uint8)
+    panels = tf.reshape(panels, [nbTargets + 1, scaleSize, scaleSize, 3])
+    return features["path"], panels
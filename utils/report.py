@@ -0,0 +1,121 @@
+import os
+import csv
+import json
+import math
+import struct
+import zlib
+import numpy as np
+
+# Results report of the test, eval and training display images, streamed into pages of pageSize pictures.
+# index.html links the pages, each page shows thumbnails linking to the full resolution images, manifest.csv lists every picture and its files
+# as soon as it is added and report.json summarizes the run when the report is closed.
+# add is meant to run on the background writer (utils.writer.AsyncWriter) : the thumbnails are made there from the fetched uint8 images.
+THUMBNAIL_SIZE = 128
+MAP_NAMES = ["normals", "diffuse", "roughness", "log(specular)"]
+
+# Minimal PNG encoder for the thumbnails, image is uint8 [height, width, 3].
+def encode_png(image):
+    height, width = image.shape[:2]
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    # every row starts with the filter type, 0 (none).
+    rows = np.concatenate([np.zeros([height, 1], dtype=np.uint8), image.reshape([height, width * 3])], axis = 1)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)) + chunk(b"IEND", b"")
+
+# Box filtered downsample of a uint8 [height, width, 3] image so that its largest side is at most size.
+def thumbnail(image, size = THUMBNAIL_SIZE):
+    factor = int(math.ceil(max(image.shape[:2]) / float(size)))
+    factor = max(1, min(factor, image.shape[0], image.shape[1]))
+    height = image.shape[0] // factor * factor
+    width = image.shape[1] // factor * factor
+    blocks = image[:height, :width].reshape([height // factor, factor, width // factor, factor, 3])
+    return np.round(blocks.mean(axis = (1, 3))).astype(np.uint8)
+
+class ResultsReport:
+    def __init__(self, outputDir, nbTargets, hasTargets, pageSize, showStep = False):
+        self.outputDir = outputDir
+        self.thumbnailDir = os.path.join(outputDir, "thumbnails")
+        if not os.path.exists(self.thumbnailDir):
+            os.makedirs(self.thumbnailDir)
+        self.pageSize = pageSize
+        self.showStep = showStep
+        self.columns = ["inputs"]
+        self.labels = ["log(input)"]
+        kinds = ["targets", "outputs"] if hasTargets else ["outputs"]
+        for kind in kinds:
+            for idImage in range(nbTargets):
+                self.columns.append(kind + str(idImage))
+                self.labels.append(kind[:-1] + " " + (MAP_NAMES[idImage] if idImage < len(MAP_NAMES) else str(idImage)))
+        self.rows = []
+        self.pages = []
+        self.count = 0
+        self.manifestFile = open(os.path.join(outputDir, "manifest.csv"), "w", newline="")
+        self.manifest = csv.writer(self.manifestFile)
+        self.manifest.writerow(["name", "step", "page"] + self.columns)
+
+    # fileset : {"name", "step", column: image file name in images/}, images : {column: uint8 [height, width, 3]} to make the thumbnails from.
+    def add(self, fileset, images):
+        thumbnails = {}
+        for column in self.columns:
+            if column in images:
+                thumbnails[column] = fileset[column].rsplit(".", 1)[0] + "-thumbnail.png"
+                with open(os.path.join(self.thumbnailDir, thumbnails[column]), "wb") as f:
+                    f.write(encode_png(thumbnail(images[column])))
+        self.rows.append((fileset, thumbnails))
+        self.manifest.writerow([fileset["name"], fileset.get("step"), self._page_name(len(self.pages))] + [fileset.get(column, "") for column in self.columns])
+        self.count += 1
+        if len(self.rows) == self.pageSize:
+            self._write_page()
+
+    def close(self):
+        if len(self.rows) > 0:
+            self._write_page()
+        self.manifestFile.close()
+        summary = {"count": self.count, "pages": self.pages, "columns": self.columns, "manifest": "manifest.csv"}
+        with open(os.path.join(self.outputDir, "report.json"), "w") as f:
+            f.write(json.dumps(summary, indent=4))
+        return os.path.join(self.outputDir, "index.html")
+
+    def _page_name(self, pageId):
+        return "page-%05d.html" % pageId
+
+    def _header(self):
+        header = "<tr>"
+        if self.showStep:
+            header += "<th>step</th>"
+        header += "<th>name</th>"
+        for label in self.labels:
+            header += "<th>%s</th>" % label
+        return header + "</tr>"
+
+    def _write_page(self):
+        pageName = self._page_name(len(self.pages))
+        with open(os.path.join(self.outputDir, pageName), "w") as page:
+            page.write("<html><body><a href='index.html'>index</a><table>")
+            page.write(self._header())
+            for fileset, thumbnails in self.rows:
+                page.write("<tr>")
+                if self.showStep:
+                    page.write("<td>%s</td>" % fileset["step"])
+                page.write("<td>%s</td>" % fileset["name"])
+                for column in self.columns:
+                    if column in thumbnails:
+                        page.write("<td><a href='images/%s'><img src='thumbnails/%s' loading='lazy'></a></td>" % (fileset[column], thumbnails[column]))
+                    else:
+                        page.write("<td></td>")
+                page.write("</tr>")
+            page.write("</table></body></html>")
+        self.pages.append(pageName)
+        self.rows = []
+        self.manifestFile.flush()
+        self._write_index()
+
+    def _write_index(self):
+        # small and rewritten whenever a page is complete, so a running report can be browsed.
+        with open(os.path.join(self.outputDir, "index.html"), "w") as index:
+            index.write("<html><body><p>%d pictures, <a href='manifest.csv'>manifest.csv</a></p><ul>" % self.count)
+            for pageId, pageName in enumerate(self.pages):
+                first = pageId * self.pageSize + 1
+                index.write("<li><a href='%s'>pictures %d to %d</a></li>" % (pageName, first, min(first + self.pageSize - 1, self.count)))
+            index.write("</ul></body></html>")
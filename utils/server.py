@@ -0,0 +1,128 @@
+# Long running inference server for material_net.py --mode serve.
+# POST /predict with an encoded picture as body returns {"normals": ..., "diffuse": ..., "roughness": ..., "specular": ...} with base64 PNG maps.
+# Concurrent requests are coalesced into batches of at most maxBatch pictures, waiting at most maxLatency seconds after the first one.
+import base64
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class _Request:
+    __slots__ = ["payload", "done", "result", "error"]
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Runs runBatch(payloads) -> results on a single thread, so the session only ever sees one batch at a time.
+# runBatch raises ValueError for payloads it cannot process, a failing batch is run again one payload at a time so only the bad requests fail.
+class RequestBatcher:
+    def __init__(self, runBatch, maxBatch, maxLatency):
+        self.runBatch = runBatch
+        self.maxBatch = maxBatch
+        self.maxLatency = maxLatency
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, payload):
+        request = _Request(payload)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.maxLatency
+        while len(batch) < self.maxBatch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run(batch)
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0].error = error
+                else:
+                    for request in batch:
+                        try:
+                            self._run([request])
+                        except Exception as requestError:
+                            request.error = requestError
+            for request in batch:
+                request.done.set()
+
+    def _run(self, batch):
+        results = self.runBatch([request.payload for request in batch])
+        for request, result in zip(batch, results):
+            request.result = result
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def _handler(batcher, maxBytes):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                self._reply(404, {"error": "unknown path " + self.path})
+                return
+            self._reply(200, {"status": "ok"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": "unknown path " + self.path})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            if length <= 0 or length > maxBytes:
+                self._reply(400, {"error": "expected an encoded picture of at most %d bytes as request body" % maxBytes})
+                return
+            payload = self.rfile.read(length)
+            start = time.time()
+            try:
+                maps = batcher.submit(payload)
+            except ValueError as error:
+                self._reply(400, {"error": str(error)})
+                return
+            except Exception as error:
+                self._reply(500, {"error": str(error)})
+                return
+            response = {name: base64.b64encode(png).decode("ascii") for name, png in maps.items()}
+            response["milliseconds"] = (time.time() - start) * 1000.0
+            self._reply(200, response)
+
+        def _reply(self, code, content):
+            body = json.dumps(content).encode("utf8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+def serve(runBatch, host, port, maxBatch, maxLatency, maxBytes = 64 * 1024 * 1024):
+    batcher = RequestBatcher(runBatch, maxBatch, maxLatency)
+    server = _ThreadingHTTPServer((host, port), _handler(batcher, maxBytes))
+    print("serving on http://%s:%d/predict, batches of up to %d pictures within %.1f ms" % (host, port, maxBatch, maxLatency * 1000.0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
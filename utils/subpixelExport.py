@@ -0,0 +1,117 @@
+# Rewrites the decoder deconv/filter weights of a trained checkpoint for --subpixelDecoder and checks every rewritten layer against the original graph.
+# Run from the repository root : python -m utils.subpixelExport --checkpoint trainedModel --output_dir trainedModelSubpixel
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+from models.cnn import tf, deconv_apply, deconv_subpixel_apply
+
+# Nearest upsample then a 4x4 SAME conv (padding 1 before, 2 after) : output row 2i + r reads the taps k = 0..3 at upsampled rows 2i + r + k - 1,
+# which are the input rows i - 1, i, i, i + 1 for r = 0 and i, i, i + 1, i + 1 for r = 1.
+# PHASE_TAPS[r][a, k] = 1 when tap k of phase r reads the input row i + a - 1.
+PHASE_TAPS = np.array([
+    [[1, 0, 0, 0], [0, 1, 1, 0], [0, 0, 0, 1]],
+    [[0, 0, 0, 0], [1, 1, 0, 0], [0, 0, 1, 1]],
+], dtype=np.float64)
+
+DECONV_FILTER = re.compile(r"^(.*/deconv/)filter(/.*)?$")
+
+# [4, 4, in_channels, out_channels] => [3, 3, in_channels, 4 * out_channels] with the channel order of depth_to_space : (ry * 2 + rx) * out_channels + c.
+# The zero taps of the odd phases are kept so the 4 phases run as one conv : 36 instead of 64 multiply-adds per input and output channel and input pixel.
+def subpixel_kernel(filter):
+    inChannels, outChannels = filter.shape[2], filter.shape[3]
+    phases = np.einsum("yak,xbl,klio->abiyxo", PHASE_TAPS, PHASE_TAPS, filter.astype(np.float64))
+    return phases.reshape([3, 3, inChannels, 4 * outChannels]).astype(filter.dtype)
+
+def rewrite_variables(reader):
+    shapes = reader.get_variable_to_shape_map()
+    variables = {}
+    rewritten = []
+    for name in sorted(shapes):
+        value = reader.get_tensor(name)
+        match = DECONV_FILTER.match(name)
+        if match is None:
+            variables[name] = value
+            continue
+        newName = match.group(1) + "subpixel_filter" + (match.group(2) or "")
+        if match.group(2) is None:
+            variables[newName] = subpixel_kernel(value)
+            rewritten.append((name, match.group(1) + "filter1"))
+        else:
+            # optimizer slots, only restored by the test graph, the rewritten weights are not trained further.
+            inChannels, outChannels = value.shape[2], value.shape[3]
+            variables[newName] = np.zeros([3, 3, inChannels, 4 * outChannels], dtype=value.dtype)
+    return variables, rewritten
+
+# Runs the original upsample-conv and the rewritten one on random inputs for every rewritten layer and returns the largest relative error.
+def check_equivalence(reader, rewritten, size, seed):
+    random = np.random.RandomState(seed)
+    worstError = 0.0
+    for filterName, filter1Name in rewritten:
+        filter = reader.get_tensor(filterName)
+        filter1 = reader.get_tensor(filter1Name)
+        input = random.randn(2, size, size, filter.shape[2]).astype(np.float32)
+        with tf.Graph().as_default():
+            reference = deconv_apply(tf.constant(input), tf.constant(filter), tf.constant(filter1))
+            output = deconv_subpixel_apply(tf.constant(input), tf.constant(subpixel_kernel(filter)), tf.constant(filter1))
+            with tf.Session() as sess:
+                referenceValue, outputValue = sess.run([reference, output])
+        error = np.max(np.abs(referenceValue - outputValue)) / max(np.max(np.abs(referenceValue)), 1e-12)
+        print("%s : max relative error %.3g" % (filterName, error))
+        worstError = max(worstError, error)
+    return worstError
+
+def save_checkpoint(variables, outputDir):
+    with tf.Graph().as_default():
+        placeholders = {}
+        assigns = []
+        varList = {}
+        for name, value in variables.items():
+            variable = tf.get_variable("v%d" % len(varList), shape=value.shape, dtype=tf.as_dtype(value.dtype), trainable=False)
+            placeholders[name] = tf.placeholder(variable.dtype.base_dtype, value.shape)
+            assigns.append(tf.assign(variable, placeholders[name]))
+            varList[name] = variable
+        # the variables are saved under their original names, with global_step unchanged.
+        saver = tf.train.Saver(varList)
+        with tf.Session() as sess:
+            sess.run(assigns, feed_dict={placeholders[name]: value for name, value in variables.items()})
+            globalStep = int(variables["global_step"]) if "global_step" in variables else None
+            return saver.save(sess, os.path.join(outputDir, "model"), global_step=globalStep)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", required=True, help="directory with the trained checkpoint and its options.json")
+    parser.add_argument("--output_dir", required=True, help="where to put the rewritten checkpoint")
+    parser.add_argument("--checkSize", type=int, default=16, help="input resolution of the equivalence check")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="largest relative error accepted by the equivalence check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    reader = tf.train.NewCheckpointReader(tf.train.latest_checkpoint(args.checkpoint))
+    variables, rewritten = rewrite_variables(reader)
+    if len(rewritten) == 0:
+        raise Exception("no deconv/filter variable in " + args.checkpoint + ", was it already exported ?")
+
+    error = check_equivalence(reader, rewritten, args.checkSize, args.seed)
+    if error > args.tolerance:
+        raise Exception("rewritten decoder differs from the original one : max relative error %.3g > %.3g" % (error, args.tolerance))
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    print("saved", save_checkpoint(variables, args.output_dir))
+
+    with open(os.path.join(args.checkpoint, "options.json")) as f:
+        options = json.loads(f.read())
+    options["subpixelDecoder"] = True
+    with open(os.path.join(args.output_dir, "options.json"), "w") as f:
+        f.write(json.dumps(options, sort_keys=True, indent=4))
+
+if __name__ == "__main__":
+    main()
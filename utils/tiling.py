@@ -0,0 +1,78 @@
+import numpy as np
+
+# Helpers of the tiled high resolution eval (create_tiled_inference in material_net.py).
+# Tiles are square, taken in row major order with a stride of tileSize - overlap, the last row and column being aligned on the picture border.
+
+def tile_starts(size, tileSize, overlap):
+    if size <= tileSize:
+        return [0]
+    starts = list(range(0, size - tileSize, tileSize - overlap))
+    starts.append(size - tileSize)
+    return starts
+
+# Separable weights of a tile : a linear ramp over the overlap on each side. They stay strictly positive so the borders of the picture,
+# covered by a single tile, keep their values once normalized by the sum of the weights.
+def blend_window(tileSize, overlap):
+    ramp = np.ones([tileSize], dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1.0) / (overlap + 1.0)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = np.minimum(ramp[-overlap:], edge[::-1])
+    return np.expand_dims(np.outer(ramp, ramp), axis = -1)
+
+# Pictures smaller than a tile are mirrored up to the tile size, the extra rows and columns are dropped by BandBlender.
+def pad_to_tile(image, tileSize):
+    padHeight = max(tileSize - image.shape[0], 0)
+    padWidth = max(tileSize - image.shape[1], 0)
+    if padHeight == 0 and padWidth == 0:
+        return image
+    return np.pad(image, [[0, padHeight], [0, padWidth], [0, 0]], mode="symmetric")
+
+# Yields batches of at most tileBatch tiles [n, tileSize, tileSize, channels] with their (y, x) positions, in row major order.
+def tile_batches(image, tileSize, overlap, tileBatch):
+    tiles = []
+    positions = []
+    for y in tile_starts(image.shape[0], tileSize, overlap):
+        for x in tile_starts(image.shape[1], tileSize, overlap):
+            tiles.append(image[y:y + tileSize, x:x + tileSize])
+            positions.append((y, x))
+            if len(tiles) == tileBatch:
+                yield np.stack(tiles, axis = 0), positions
+                tiles = []
+                positions = []
+    if len(tiles) > 0:
+        yield np.stack(tiles, axis = 0), positions
+
+# Blends tiles added in row major order. Only the tileSize rows still covered by upcoming tiles are accumulated, the rows above
+# a new row of tiles are final : they are normalized and handed to finish(y, rows) with rows [n, width, channels], cropped to height and width.
+class BandBlender:
+    def __init__(self, height, width, channels, tileSize, overlap, finish):
+        self.height = height
+        self.width = width
+        self.tileSize = tileSize
+        self.finish = finish
+        self.window = blend_window(tileSize, overlap)
+        paddedWidth = max(width, tileSize)
+        self.values = np.zeros([tileSize, paddedWidth, channels], dtype=np.float32)
+        self.weights = np.zeros([tileSize, paddedWidth, 1], dtype=np.float32)
+        self.top = 0
+
+    def add(self, tile, y, x):
+        if y > self.top:
+            self._flush(y - self.top)
+        self.values[:, x:x + self.tileSize] += tile * self.window
+        self.weights[:, x:x + self.tileSize] += self.window
+
+    def close(self):
+        self._flush(self.tileSize)
+
+    def _flush(self, nbRows):
+        rows = self.values[:nbRows] / np.maximum(self.weights[:nbRows], 1e-8)
+        nbFinalRows = min(nbRows, self.height - self.top)
+        if nbFinalRows > 0:
+            self.finish(self.top, rows[:nbFinalRows, :self.width])
+        self.values = np.roll(self.values, -nbRows, axis = 0)
+        self.weights = np.roll(self.weights, -nbRows, axis = 0)
+        self.values[-nbRows:] = 0.0
+        self.weights[-nbRows:] = 0.0
+        self.top += nbRows
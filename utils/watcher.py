@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+# Background evaluation of the training checkpoints : material_net.py --mode train --backgroundTest starts material_net.py --mode watch
+# in a separate low priority process, which evaluates every new checkpoint of the training output_dir while the training goes on.
+# The trainer writes DONE_MARKER once its last checkpoint is saved, the watcher then evaluates it if needed and exits.
+DONE_MARKER = "training.done"
+EVALUATED_FILE = "evaluated.json"
+
+def mark_training_done(outputDir):
+    with open(os.path.join(outputDir, DONE_MARKER), "w") as f:
+        f.write(str(time.time()))
+
+def clear_training_done(outputDir):
+    markerPath = os.path.join(outputDir, DONE_MARKER)
+    if os.path.exists(markerPath):
+        os.remove(markerPath)
+
+# Starts the watcher with the trainer command line, the later --mode, --checkpoint and --output_dir values override the training ones.
+def spawn_evaluator(outputDir, niceness):
+    command = [sys.executable] + sys.argv + ["--mode", "watch", "--checkpoint", outputDir, "--output_dir", outputDir]
+    def lower_priority():
+        os.nice(niceness)
+    preexec = lower_priority if niceness > 0 and hasattr(os, "nice") else None
+    return subprocess.Popen(command, preexec_fn=preexec)
+
+# Calls evaluate(checkpoint) for every new checkpoint returned by latestCheckpoint(), polling every interval seconds until the training is done.
+# evaluate returns False when the checkpoint disappeared before it could be restored (replaced by a newer one), it is then skipped.
+# The evaluated checkpoints are kept in EVALUATED_FILE so a restarted watcher does not evaluate them again.
+def watch_checkpoints(outputDir, latestCheckpoint, evaluate, interval):
+    evaluatedPath = os.path.join(outputDir, EVALUATED_FILE)
+    evaluated = []
+    if os.path.exists(evaluatedPath):
+        with open(evaluatedPath) as f:
+            evaluated = json.loads(f.read())
+    while True:
+        # checked before looking for a checkpoint, so the one saved just before the marker is always seen.
+        done = os.path.exists(os.path.join(outputDir, DONE_MARKER))
+        checkpoint = latestCheckpoint()
+        if checkpoint is not None and os.path.basename(checkpoint) not in evaluated:
+            if evaluate(checkpoint):
+                evaluated.append(os.path.basename(checkpoint))
+                with open(evaluatedPath, "w") as f:
+                    f.write(json.dumps(evaluated, indent=4))
+            else:
+                time.sleep(interval)
+            continue
+        if done:
+            return evaluated
+        time.sleep(interval)
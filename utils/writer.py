@@ -0,0 +1,63 @@
+import queue
+import threading
+
+# Runs the output writes (save_images, the results report, ...) on a background thread while the next batch is evaluated.
+# Tasks run one at a time in submission order. The queue is bounded so a slow disk slows down the evaluation instead of piling up fetched batches.
+# The first error of a task is raised again by the next submit or by close, which waits for the queued tasks and stops the thread.
+# With maxPending 0 the tasks run synchronously in submit.
+class AsyncWriter:
+    def __init__(self, maxPending):
+        self.error = None
+        self.thread = None
+        if maxPending > 0:
+            self.tasks = queue.Queue(maxPending)
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, function, *args):
+        self._raise_error()
+        if self.thread is None:
+            function(*args)
+        else:
+            self.tasks.put((function, args))
+
+    def close(self):
+        if self.thread is not None:
+            self.tasks.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # already failing : only wait for the pending writes.
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def _loop(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                # a write failed, the next ones are dropped until the error is reported.
+                continue
+            function, args = task
+            try:
+                function(*args)
+            except Exception as error:
+                self.error = error